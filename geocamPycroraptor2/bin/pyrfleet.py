@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import sys
+
+from geocamPycroraptor2.fleet import Fleet
+
+COMMANDS = ('status', 'start', 'stop', 'restart')
+
+
+def printErrors(errors):
+    for name in sorted(errors.keys()):
+        print >> sys.stderr, '%s: ERROR %s' % (name, errors[name])
+
+
+def pyrfleet(opts, cmd, svcName):
+    names = opts.names.split(',') if opts.names else None
+    fleet = Fleet(opts.ports, names, opts.timeout)
+    if cmd == 'status':
+        statusByService, errors = fleet.getServiceStatus()
+        for key in sorted(statusByService.keys()):
+            print '%-40s %s' % (key, statusByService[key].get('status'))
+    else:
+        method = {'start': 'startService',
+                  'stop': 'stopService',
+                  'restart': 'restart'}[cmd]
+        results, errors = fleet.call(method, svcName)
+        for name in sorted(results.keys()):
+            print '%s: ok' % name
+    printErrors(errors)
+    fleet.close()
+    return 1 if errors else 0
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: %prog [options] status\n'
+                                   '   or: %prog [options] <start|stop|restart> <service>\n\n'
+                                   'Run a command on many pyraptord instances at once.')
+    parser.add_option('-p', '--ports',
+                      help='Ports file listing the pyraptord instances [%default]',
+                      default='ports.json')
+    parser.add_option('-n', '--names',
+                      help='Comma-separated instance names to use (default: all entries with an rpc endpoint)')
+    parser.add_option('-t', '--timeout',
+                      type='float', default=5.0,
+                      help='Per-instance timeout in seconds [%default]')
+    opts, args = parser.parse_args()
+    if not args or args[0] not in COMMANDS:
+        parser.error('expected a command: %s' % ', '.join(COMMANDS))
+    cmd = args[0]
+    if cmd == 'status':
+        if len(args) != 1:
+            parser.error('status takes no arguments')
+        svcName = None
+    else:
+        if len(args) != 2:
+            parser.error('%s takes exactly one service name' % cmd)
+        svcName = args[1]
+    sys.exit(pyrfleet(opts, cmd, svcName))
+
+
+if __name__ == '__main__':
+    main()
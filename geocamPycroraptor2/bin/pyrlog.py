@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import sys
+import time
+import calendar
+
+from geocamPycroraptor2 import logquery
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%dT%H:%M',
+                '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d %H:%M')
+
+
+def parseTime(text):
+    """
+    Parse a UTC time like '2013-05-01T14:02' or seconds since the epoch.
+    """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in TIME_FORMATS:
+        try:
+            return calendar.timegm(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    raise ValueError('could not parse time "%s"' % text)
+
+
+def pyrlog(opts, path):
+    if opts.all or opts.topic or opts.grep:
+        lines = logquery.queryLog(logquery.getTemplateForPath(path), {},
+                                  opts.start,
+                                  opts.end,
+                                  opts.topic,
+                                  opts.grep,
+                                  opts.maxLines)
+        for line in lines:
+            sys.stdout.write(line + '\n')
+        return
+
+    lines, truncated = logquery.readRange(path,
+                                          opts.start,
+                                          opts.end,
+                                          opts.maxBytes)
+    for line in lines:
+        sys.stdout.write(line + '\n')
+    if truncated:
+        print >> sys.stderr, 'output truncated at %d bytes' % opts.maxBytes
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: %prog [options] <logFile>\n\n'
+                                   'Print the lines of a pyraptord log file in a time range.\n'
+                                   'Times are UTC, e.g. 2013-05-01T14:02, or seconds since the epoch.\n'
+                                   'Binary log files are printed in the text log format.')
+    parser.add_option('-s', '--start',
+                      help='Print lines logged at or after this time')
+    parser.add_option('-e', '--end',
+                      help='Print lines logged at or before this time')
+    parser.add_option('-m', '--maxBytes',
+                      type='int', default=None,
+                      help='Stop after this many bytes of output')
+    parser.add_option('-a', '--all',
+                      action='store_true', default=False,
+                      help='Search all segments of the log, including rotated ones')
+    parser.add_option('-t', '--topic',
+                      action='append', default=[],
+                      help='Only print lines with this topic (out, err, inp or evt); may be repeated; implies --all')
+    parser.add_option('-g', '--grep',
+                      help='Only print lines matching this regular expression; implies --all')
+    parser.add_option('-n', '--maxLines',
+                      type='int', default=None,
+                      help='With --all, stop after this many lines')
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected exactly one log file')
+    try:
+        if opts.start:
+            opts.start = parseTime(opts.start)
+        if opts.end:
+            opts.end = parseTime(opts.end)
+    except ValueError, e:
+        parser.error(str(e))
+    try:
+        pyrlog(opts, args[0])
+    except ValueError, e:
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Compact binary log format, an alternative to the text log format for
+services with logFormat 'binary'.
+
+A segment starts with an 8-byte magic string, then a uint16 length and
+the topic prefix (for example 'service.foo'). Each record after that is:
+
+  uint32  payload length
+  uint64  timestamp, nanoseconds since the epoch
+  uint16  topic id
+  uint8   flags
+  bytes   payload
+
+all little-endian. Topic ids 1-4 are the prefix followed by '.out',
+'.err', '.inp' and '.evt', and 0 is the prefix itself. Records with
+other topics use INLINE_TOPIC_ID and carry '<topic>\\0' before the
+payload. Since ids are fixed, a reader can start at any record offset
+from the index after reading only the header.
+
+For console text, the flags record how the line ended (the 'n', 'r' or
+'c' marker of the text format) and the payload is the raw line. Other
+messages have FLAG_RAW set.
+"""
+
+import os
+import gzip
+import mmap
+import struct
+
+from geocamPycroraptor2 import log, logindex
+
+BINARY_SUFFIX = '.bin'
+MAGIC = 'PYRLOG\x00\x01'
+PREFIX_LENGTH = struct.Struct('<H')
+RECORD_HEADER = struct.Struct('<IQHB')
+
+FLAG_EOL_NEWLINE = 1
+FLAG_EOL_CR = 2
+FLAG_RAW = 4
+
+TOPIC_SUFFIXES = ('', 'out', 'err', 'inp', 'evt')
+INLINE_TOPIC_ID = 0xFFFF
+
+_EOL_FLAGS = {'n': FLAG_EOL_NEWLINE,
+              'r': FLAG_EOL_CR,
+              'c': 0}
+
+
+def isBinarySegment(path):
+    if path.endswith('.gz'):
+        path = path[:-3]
+    return path.endswith(BINARY_SUFFIX)
+
+
+def makeHeader(topicPrefix):
+    return MAGIC + PREFIX_LENGTH.pack(len(topicPrefix)) + topicPrefix
+
+
+class RecordEncoder(object):
+    """
+    Encodes log records for a segment whose topics start with
+    *topicPrefix*.
+    """
+
+    def __init__(self, topicPrefix):
+        self._topicPrefix = topicPrefix
+        self._topicIds = {topicPrefix: 0}
+        for i, suffix in enumerate(TOPIC_SUFFIXES[1:]):
+            self._topicIds['%s.%s' % (topicPrefix, suffix)] = i + 1
+        self._streamIds = dict([(suffix, i) for i, suffix in enumerate(TOPIC_SUFFIXES)])
+
+    def getHeader(self):
+        return makeHeader(self._topicPrefix)
+
+    def encodeConsoleLines(self, created, stream, texts):
+        """
+        Encode *texts* from console *stream* ('out', 'err' or 'inp'),
+        each with its end of line escaped by log.escapeEndOfLine().
+        """
+        ns = int(round(created * 1e9))
+        topicId = self._streamIds[stream]
+        pack = RECORD_HEADER.pack
+        chunks = []
+        for text in texts:
+            payload = text[2:]
+            chunks.append(pack(len(payload), ns, topicId, _EOL_FLAGS.get(text[:1], 0)))
+            chunks.append(payload)
+        return ''.join(chunks)
+
+    def encodeMessage(self, created, topic, text, flags=FLAG_RAW):
+        if isinstance(text, unicode):
+            text = text.encode('utf8')
+        topicId = self._topicIds.get(topic)
+        if topicId is None:
+            topicId = INLINE_TOPIC_ID
+            text = '%s\0%s' % (topic, text)
+        ns = int(round(created * 1e9))
+        return RECORD_HEADER.pack(len(text), ns, topicId, flags) + text
+
+
+def splitTopicFlags(name):
+    """
+    Split a logger name like 'service.foo.evt n' into the topic and the
+    flags for its end of line marker. Names without a marker get
+    FLAG_RAW.
+    """
+    if len(name) > 2 and name[-2] == ' ' and name[-1] in _EOL_FLAGS:
+        return name[:-2], _EOL_FLAGS[name[-1]]
+    return name, FLAG_RAW
+
+
+class BinaryLogWriterHandler(log.LogWriterHandler):
+    """
+    Writes log records to a LogWriter in the binary format.
+    """
+
+    def __init__(self, writer, encoder):
+        super(BinaryLogWriterHandler, self).__init__(writer)
+        self._encoder = encoder
+
+    def emit(self, rec):
+        try:
+            topic, flags = splitTopicFlags(rec.name)
+            data = self._encoder.encodeMessage(rec.created, topic, self.format(rec), flags)
+            self._writer.write(data, created=rec.created)
+        except:  # pylint: disable=W0702
+            self.handleError(rec)
+
+
+def readTopicPrefix(f):
+    """
+    Read the segment header from file-like *f* and return the topic
+    prefix.
+    """
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError('not a binary pyraptord log')
+    (n,) = PREFIX_LENGTH.unpack(f.read(PREFIX_LENGTH.size))
+    return f.read(n)
+
+
+def iterRecords(f, topicPrefix):
+    """
+    Yield (created, topic, flags, payload) for each record from
+    file-like *f*, starting at its current position. A partial record
+    at the end (still being written) is ignored.
+    """
+    topics = [topicPrefix] + ['%s.%s' % (topicPrefix, suffix)
+                              for suffix in TOPIC_SUFFIXES[1:]]
+    headerSize = RECORD_HEADER.size
+    unpack = RECORD_HEADER.unpack
+    while 1:
+        header = f.read(headerSize)
+        if len(header) < headerSize:
+            return
+        length, ns, topicId, flags = unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            return
+        if topicId == INLINE_TOPIC_ID:
+            topic, payload = payload.split('\0', 1)
+        else:
+            topic = topics[topicId]
+        yield ns * 1e-9, topic, flags, payload
+
+
+def formatRecord(created, topic, flags, payload):
+    """
+    Return the text log format line for a record.
+    """
+    if flags & FLAG_RAW:
+        text = payload
+    elif flags & FLAG_EOL_NEWLINE:
+        text = 'n ' + payload
+    elif flags & FLAG_EOL_CR:
+        text = 'r ' + payload
+    else:
+        text = 'c ' + payload
+    return log.formatLine(created, topic, text)
+
+
+def _openSegment(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def iterSegmentLines(path, startTime=None, endTime=None):
+    """
+    Yield (topic, line) for records in the binary segment at *path*
+    with timestamps in [*startTime*, *endTime*], with each line in the
+    text log format. Uses the segment index to skip to *startTime*.
+    """
+    f = _openSegment(path)
+    if f is None:
+        return
+    try:
+        topicPrefix = readTopicPrefix(f)
+        startOffset = logindex.findStartOffset(logindex.getIndexPath(path), startTime)
+        if startOffset:
+            f.seek(startOffset)
+        for created, topic, flags, payload in iterRecords(f, topicPrefix):
+            if startTime is not None and created < startTime:
+                continue
+            if endTime is not None and created > endTime:
+                return
+            yield topic, formatRecord(created, topic, flags, payload)
+    finally:
+        f.close()
+
+
+def readRange(segmentPath, startTime=None, endTime=None, maxBytes=None):
+    """
+    Like logindex.readRange(), for a binary segment.
+    """
+    lines = iterSegmentLines(os.path.realpath(segmentPath), startTime, endTime)
+    return logindex.takeBytes((line for _topic, line in lines), maxBytes)
+
+
+def convertToText(path, out):
+    """
+    Write the binary segment at *path* to file-like *out* in the text
+    log format.
+    """
+    for _topic, line in iterSegmentLines(os.path.realpath(path)):
+        out.write(line + '\n')
@@ -0,0 +1,78 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Structured comparison of two pyraptord configs, used to apply a
+reloaded config without disturbing services whose config didn't change.
+"""
+
+# service config fields that only take effect when the service restarts
+RESTART_FIELDS = ('command', 'env', 'cwd')
+
+# global settings that only take effect when pyraptord restarts
+DAEMON_RESTART_SETTINGS = ('LOG_DIR', 'LOG_FILE', 'PID_FILE', 'PORTS',
+                           'SUBSCRIBER_QUEUE_SIZE')
+
+
+def diffDicts(old, new):
+    """
+    Return (added, removed, changed) sorted lists of the keys of dicts
+    *old* and *new*.
+    """
+    added = sorted([k for k in new if k not in old])
+    removed = sorted([k for k in old if k not in new])
+    changed = sorted([k for k in new if k in old and new[k] != old[k]])
+    return added, removed, changed
+
+
+def _diffSection(old, new):
+    added, removed, changed = diffDicts(old or {}, new or {})
+    return dict(added=added, removed=removed, changed=changed)
+
+
+def diffConfig(old, new):
+    """
+    Compare configs *old* and *new*. Returns a dict:
+
+      services: {added, removed, changed} service names, plus
+                'fields', mapping each changed service to the names of
+                its changed fields, and 'needsRestart', the changed
+                services with a changed RESTART_FIELDS field
+      groups:   {added, removed, changed} group names
+      settings: {added, removed, changed} other top-level keys, plus
+                'needsDaemonRestart'
+    """
+    services = _diffSection(old.get('SERVICES'), new.get('SERVICES'))
+    services['fields'] = {}
+    services['needsRestart'] = []
+    for name in services['changed']:
+        oldSvc = old['SERVICES'][name] or {}
+        newSvc = new['SERVICES'][name] or {}
+        added, removed, changed = diffDicts(oldSvc, newSvc)
+        fields = sorted(added + removed + changed)
+        services['fields'][name] = fields
+        if any([f in RESTART_FIELDS for f in fields]):
+            services['needsRestart'].append(name)
+
+    groups = _diffSection(old.get('GROUPS'), new.get('GROUPS'))
+
+    oldSettings = dict([(k, v) for k, v in old.iteritems()
+                        if k not in ('SERVICES', 'GROUPS')])
+    newSettings = dict([(k, v) for k, v in new.iteritems()
+                        if k not in ('SERVICES', 'GROUPS')])
+    settings = _diffSection(oldSettings, newSettings)
+    settings['needsDaemonRestart'] = [k for k in (settings['added']
+                                                  + settings['removed']
+                                                  + settings['changed'])
+                                      if k in DAEMON_RESTART_SETTINGS]
+
+    return dict(services=services, groups=groups, settings=settings)
+
+
+def isEmpty(diff):
+    return not any([diff[section][kind]
+                    for section in ('services', 'groups', 'settings')
+                    for kind in ('added', 'removed', 'changed')])
@@ -0,0 +1,150 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import os
+import errno
+import struct
+import logging
+import traceback
+import ctypes
+import ctypes.util
+
+import gevent
+import gevent.socket
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000  # O_CLOEXEC
+
+# struct inotify_event: wd, mask, cookie, len, then name
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _getLibc():
+    global _libc  # pylint: disable=W0603
+    if _libc is None:
+        libcPath = ctypes.util.find_library('c')
+        try:
+            lib = ctypes.CDLL(libcPath, use_errno=True)
+            lib.inotify_init1  # pylint: disable=W0104
+        except (OSError, AttributeError):
+            lib = False
+        _libc = lib
+    return _libc
+
+
+def _openInotify(dirName):
+    """
+    Return an inotify fd watching *dirName* for files being written or
+    renamed into place, or None if inotify is not available.
+    """
+    lib = _getLibc()
+    if not lib:
+        return None
+    fd = lib.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    wd = lib.inotify_add_watch(fd, dirName, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+    if wd < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _parseEventNames(data):
+    names = []
+    pos = 0
+    while pos + EVENT_HEADER.size <= len(data):
+        _wd, _mask, _cookie, length = EVENT_HEADER.unpack_from(data, pos)
+        pos += EVENT_HEADER.size
+        names.append(data[pos:pos + length].rstrip('\0'))
+        pos += length
+    return names
+
+
+class FileWatcher(object):
+    """
+    Calls *callback()* in a new greenlet when the file at *path* is
+    changed. Uses inotify on the file's directory when available (so
+    files replaced by rename are seen too) and otherwise polls the
+    file's status every *pollSeconds*. Bursts of changes within
+    *settleSeconds* produce a single callback.
+    """
+
+    def __init__(self, path, callback, pollSeconds=2.0, settleSeconds=0.5):
+        self._path = os.path.realpath(path)
+        self._callback = callback
+        self._pollSeconds = pollSeconds
+        self._settleSeconds = settleSeconds
+        self._fd = None
+        self._job = None
+        self._pending = None
+        self.method = None
+
+    def start(self):
+        self._fd = _openInotify(os.path.dirname(self._path))
+        if self._fd is not None:
+            self.method = 'inotify'
+            self._job = gevent.spawn(self._inotifyLoop)
+        else:
+            self.method = 'poll'
+            self._job = gevent.spawn(self._pollLoop)
+
+    def stop(self):
+        if self._job is not None:
+            self._job.kill()
+            self._job = None
+        if self._pending is not None:
+            self._pending.kill()
+            self._pending = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _inotifyLoop(self):
+        baseName = os.path.basename(self._path)
+        while 1:
+            gevent.socket.wait_read(self._fd)
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError, oe:
+                if oe.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if baseName in _parseEventNames(data):
+                self._changed()
+
+    def _getSignature(self):
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _pollLoop(self):
+        signature = self._getSignature()
+        while 1:
+            gevent.sleep(self._pollSeconds)
+            newSignature = self._getSignature()
+            if newSignature != signature:
+                signature = newSignature
+                self._changed()
+
+    def _changed(self):
+        if self._pending is None:
+            self._pending = gevent.spawn_later(self._settleSeconds, self._fire)
+
+    def _fire(self):
+        self._pending = None
+        try:
+            self._callback()
+        except:  # pylint: disable=W0702
+            logging.warning('error handling change to %s', self._path)
+            logging.warning(traceback.format_exc())
@@ -0,0 +1,141 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import sys
+import logging
+
+import gevent
+import gevent.monkey
+gevent.monkey.patch_all(thread=False)
+import zerorpc
+
+from geocamPycroraptor2.util import loadConfig
+
+DEFAULT_TIMEOUT = 5.0
+
+
+class FleetError(Exception):
+    pass
+
+
+class Fleet(object):
+    """
+    Client for many pyraptord instances at once. *ports* is a ports
+    file path (or an already loaded ports dict) and *names* selects the
+    instances to talk to (by default, every entry with an 'rpc'
+    endpoint).
+
+    One zerorpc client per instance is created on first use and reused
+    for later calls. A client that fails or times out is closed and
+    replaced on the next call.
+
+    Calls go to all instances concurrently, each with its own
+    *timeout* in seconds, so a fleet-wide call takes about as long as
+    the slowest instance rather than the sum of all of them. Each
+    fleet call returns a dict of results and a dict of error messages,
+    both keyed by instance name.
+    """
+
+    def __init__(self, ports, names=None, timeout=DEFAULT_TIMEOUT):
+        if isinstance(ports, basestring):
+            ports = loadConfig(ports)
+        if names is None:
+            names = sorted([name for name, entry in ports.iteritems()
+                            if hasattr(entry, 'get') and entry.get('rpc')])
+        else:
+            unknown = [name for name in names if name not in ports]
+            if unknown:
+                raise FleetError('unknown pyraptord names: %s' % ', '.join(unknown))
+        self._endpoints = dict([(name, ports[name]['rpc']) for name in names])
+        self._names = list(names)
+        self._timeout = timeout
+        self._clients = {}
+
+    def getNames(self):
+        return list(self._names)
+
+    def getClient(self, name):
+        client = self._clients.get(name)
+        if client is None:
+            client = zerorpc.Client(self._endpoints[name], timeout=self._timeout)
+            self._clients[name] = client
+        return client
+
+    def _discardClient(self, name):
+        client = self._clients.pop(name, None)
+        if client is not None:
+            try:
+                client.close()
+            except:  # pylint: disable=W0702
+                pass
+
+    def _callOne(self, name, method, args, timeout):
+        try:
+            with gevent.Timeout(timeout, FleetError('timed out after %ss' % timeout)):
+                return True, self.getClient(name)(method, *args)
+        except zerorpc.RemoteError, err:
+            # the instance answered; the connection is fine
+            return False, '%s: %s' % (err.name, err.msg)
+        except:  # pylint: disable=W0702
+            self._discardClient(name)
+            excType, excValue = sys.exc_info()[:2]
+            return False, '%s: %s' % (excType.__name__, excValue)
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call *method* with *args* on every instance (or the instances
+        listed in keyword argument *names*) concurrently. Keyword
+        argument *timeout* overrides the per-instance timeout. Returns
+        (results, errors).
+        """
+        names = kwargs.get('names') or self._names
+        timeout = kwargs.get('timeout') or self._timeout
+        jobs = dict([(name, gevent.spawn(self._callOne, name, method, args, timeout))
+                     for name in names])
+        gevent.joinall(jobs.values())
+        results = {}
+        errors = {}
+        for name, job in jobs.iteritems():
+            ok, value = job.value
+            if ok:
+                results[name] = value
+            else:
+                errors[name] = value
+                logging.debug('fleet: %s(%s) failed on %s: %s',
+                              method, ', '.join([repr(a) for a in args]), name, value)
+        return results, errors
+
+    def getStatusAll(self, **kwargs):
+        """
+        Return (statusByInstance, errors), where statusByInstance maps
+        each instance name to its getStatusAll() result.
+        """
+        return self.call('getStatusAll', **kwargs)
+
+    def getServiceStatus(self, **kwargs):
+        """
+        Return (statusByService, errors), where statusByService maps
+        'instance.service' to the status of that service.
+        """
+        results, errors = self.getStatusAll(**kwargs)
+        merged = {}
+        for name, statusAll in results.iteritems():
+            for svcName, status in statusAll.iteritems():
+                merged['%s.%s' % (name, svcName)] = status
+        return merged, errors
+
+    def startService(self, svcName, **kwargs):
+        return self.call('startService', svcName, **kwargs)
+
+    def stopService(self, svcName, **kwargs):
+        return self.call('stopService', svcName, **kwargs)
+
+    def restart(self, svcName, **kwargs):
+        return self.call('restart', svcName, **kwargs)
+
+    def close(self):
+        for name in self._clients.keys():
+            self._discardClient(name)
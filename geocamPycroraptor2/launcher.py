@@ -0,0 +1,123 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import gevent
+import gevent.event
+import gevent.lock
+
+from geocamPycroraptor2 import prexceptions
+from geocamPycroraptor2 import status as statuslib
+
+
+class GroupLauncher(object):
+    """
+    Starts a group of services concurrently. A service can list other
+    services in the 'after' field of its config; it is started as soon
+    as all of those services are running. At most *concurrency*
+    services are launched at once.
+
+    Launches only overlap when they go through the zygote, whose start
+    waits for the zygote's reply. With the spawn and fork launch methods
+    Service.start() does not yield, so the group is started one service
+    at a time and *concurrency* has no effect; 'after' ordering still
+    applies.
+
+    Prerequisites that are not part of the group are only waited for
+    if they are already active. Services that are part of a dependency
+    cycle, or whose prerequisites fail to start, are not started.
+    """
+
+    def __init__(self, manager, svcNames, concurrency=8):
+        self._manager = manager
+        self._logger = manager._logger
+        self._svcNames = []
+        for svcName in svcNames:
+            if svcName not in self._svcNames:
+                self._svcNames.append(svcName)
+        self._lock = gevent.lock.BoundedSemaphore(max(1, concurrency))
+        self._ready = dict([(svcName, gevent.event.AsyncResult())
+                            for svcName in self._svcNames])
+
+    def _getPrerequisites(self, svcName):
+        svcConfig = self._manager._config.SERVICES.get(svcName)
+        if svcConfig is None:
+            return []
+        after = svcConfig.get('after', [])
+        if isinstance(after, basestring):
+            after = [after]
+        result = []
+        for dep in after:
+            if dep in self._ready:
+                result.append(dep)
+            else:
+                svc = self._manager._services.get(dep)
+                if svc is None or not svc.isActive():
+                    self._logger.warning('%s: prerequisite %s is not in the group and not running, ignoring it',
+                                         svcName, dep)
+        return result
+
+    def _getDependencyGraph(self):
+        graph = dict([(svcName, self._getPrerequisites(svcName))
+                      for svcName in self._svcNames])
+
+        # drop services that are part of (or wait on) a dependency cycle
+        VISITING, DONE = 1, 2
+        state = {}
+        cyclic = set()
+
+        def visit(svcName):
+            state[svcName] = VISITING
+            for dep in graph[svcName]:
+                depState = state.get(dep)
+                if depState == VISITING or dep in cyclic:
+                    cyclic.add(svcName)
+                elif depState is None:
+                    visit(dep)
+                    if dep in cyclic:
+                        cyclic.add(svcName)
+            state[svcName] = DONE
+
+        for svcName in self._svcNames:
+            if svcName not in state:
+                visit(svcName)
+        for svcName in self._svcNames:
+            if svcName in cyclic:
+                self._logger.error('%s: dependency cycle in "after" config, not starting it',
+                                   svcName)
+        return graph, cyclic
+
+    def _launch(self, svcName, prerequisites):
+        for dep in prerequisites:
+            if not self._ready[dep].get():
+                self._logger.warning('%s: prerequisite %s did not start, not starting it',
+                                     svcName, dep)
+                self._ready[svcName].set(False)
+                return
+        with self._lock:
+            try:
+                self._manager.startService(svcName)
+            except prexceptions.ServiceAlreadyActive:
+                pass
+            except prexceptions.UnknownService:
+                self._logger.warning('unknown service %s', svcName)
+                self._ready[svcName].set(False)
+                return
+        svc = self._manager._services[svcName]
+        self._ready[svcName].set(svc.getStatus()['status'] == statuslib.RUNNING)
+
+    def run(self):
+        """
+        Start the group and block until every service has been started
+        or skipped.
+        """
+        graph, cyclic = self._getDependencyGraph()
+        jobs = []
+        for svcName in self._svcNames:
+            if svcName in cyclic:
+                self._ready[svcName].set(False)
+            else:
+                jobs.append(gevent.spawn(self._launch, svcName, graph[svcName]))
+        gevent.joinall(jobs)
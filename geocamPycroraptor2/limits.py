@@ -0,0 +1,264 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Per-service resource limits, applied with setrlimit() in the child and,
+when a writable cgroup v2 hierarchy is available, by running each
+service in its own cgroup.
+
+The 'limits' field of a service config may contain:
+
+  memoryMax  bytes, or a string like '512M' (cgroup memory.max; without
+             a cgroup, RLIMIT_AS)
+  cpuWeight  1-10000, default 100 (cgroup cpu.weight)
+  cpuQuota   number of CPUs the service may use, e.g. 0.5 (cgroup cpu.max)
+  pidsMax    max processes and threads (cgroup pids.max)
+  nofile     max open files (RLIMIT_NOFILE)
+"""
+
+import os
+import errno
+import resource
+
+LIMIT_FIELDS = ('memoryMax', 'cpuWeight', 'cpuQuota', 'pidsMax', 'nofile')
+
+CGROUP_CONTROLLERS = ('memory', 'cpu', 'pids')
+
+# cgroup names under the base dir
+SERVICE_CGROUP_PREFIX = 'service-'
+DAEMON_CGROUP = 'pyraptord'
+
+CPU_PERIOD_USEC = 100000
+
+BYTE_UNITS = {'K': 1024,
+              'M': 1024 ** 2,
+              'G': 1024 ** 3,
+              'T': 1024 ** 4}
+
+
+def parseBytes(value):
+    if isinstance(value, basestring):
+        value = value.strip()
+        unit = value[-1:].upper()
+        if unit in BYTE_UNITS:
+            return int(float(value[:-1]) * BYTE_UNITS[unit])
+        return int(value)
+    return int(value)
+
+
+def parseLimits(limits):
+    """
+    Check and normalize a 'limits' config dict. Raises ValueError.
+    """
+    if not limits:
+        return {}
+    unknown = [k for k in limits if k not in LIMIT_FIELDS]
+    if unknown:
+        raise ValueError('unknown limits: %s (expected some of %s)'
+                         % (', '.join(sorted(unknown)), ', '.join(LIMIT_FIELDS)))
+    result = {}
+    if limits.get('memoryMax') is not None:
+        result['memoryMax'] = parseBytes(limits['memoryMax'])
+    if limits.get('cpuWeight') is not None:
+        cpuWeight = int(limits['cpuWeight'])
+        if not 1 <= cpuWeight <= 10000:
+            raise ValueError('cpuWeight should be between 1 and 10000, got %s' % cpuWeight)
+        result['cpuWeight'] = cpuWeight
+    if limits.get('cpuQuota') is not None:
+        cpuQuota = float(limits['cpuQuota'])
+        if cpuQuota <= 0:
+            raise ValueError('cpuQuota should be positive, got %s' % cpuQuota)
+        result['cpuQuota'] = cpuQuota
+    for field in ('pidsMax', 'nofile'):
+        if limits.get(field) is not None:
+            result[field] = int(limits[field])
+    return result
+
+
+def getRlimits(limits, controllers=()):
+    """
+    Return [[resourceName, soft, hard], ...] to apply in the child.
+    *controllers* are the cgroup controllers enforcing the other limits;
+    without the memory controller, the memory limit falls back to
+    RLIMIT_AS.
+    """
+    rlimits = []
+    if 'nofile' in limits:
+        rlimits.append(['RLIMIT_NOFILE', limits['nofile'], limits['nofile']])
+    if 'memoryMax' in limits and 'memory' not in controllers:
+        rlimits.append(['RLIMIT_AS', limits['memoryMax'], limits['memoryMax']])
+    return rlimits
+
+
+def enterLimits(rlimits, cgroupProcs):
+    """
+    Runs in the child before exec().
+    """
+    if cgroupProcs:
+        with open(cgroupProcs, 'w') as f:
+            f.write('0')
+    for name, soft, hard in rlimits:
+        resource.setrlimit(getattr(resource, name), (soft, hard))
+
+
+def getPreexecFn(rlimits, cgroupProcs, preexecFn=None):
+    def preexec():
+        enterLimits(rlimits, cgroupProcs)
+        if preexecFn is not None:
+            preexecFn()
+    return preexec
+
+
+def _readText(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _writeText(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def _readKeyValues(path):
+    result = {}
+    for line in _readText(path).splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            result[fields[0]] = int(fields[1])
+    return result
+
+
+def findCgroupMount():
+    with open('/proc/mounts') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 2 and fields[2] == 'cgroup2':
+                return fields[1]
+    return None
+
+
+def getOwnCgroup():
+    with open('/proc/self/cgroup') as f:
+        for line in f:
+            if line.startswith('0::'):
+                return line[3:].strip()
+    return None
+
+
+class CgroupManager(object):
+    """
+    Creates a cgroup v2 for each service with limits under base dir
+    *root* (by default, the cgroup pyraptord was started in). Processes
+    already in the base dir, including pyraptord itself, are moved into
+    a 'pyraptord' leaf cgroup, because cgroup v2 only lets a cgroup
+    without processes hand out resources to child cgroups.
+    """
+
+    def __init__(self, root=None, logger=None):
+        self._root = root
+        self._logger = logger
+        self._base = None
+        self._controllers = []
+
+    def setup(self):
+        """
+        Prepare the base dir. Returns True on success; on failure, logs
+        the reason and returns False.
+        """
+        try:
+            mount = findCgroupMount()
+            if mount is None:
+                raise EnvironmentError(errno.ENOENT, 'no cgroup2 file system mounted')
+            root = self._root
+            if root is None:
+                root = os.path.join(mount, (getOwnCgroup() or '/').lstrip('/'))
+            root = os.path.realpath(root)
+            if not os.access(os.path.join(root, 'cgroup.subtree_control'), os.W_OK):
+                raise EnvironmentError(errno.EACCES, 'cgroup %s is not writable' % root)
+
+            if root != os.path.realpath(mount):
+                procs = _readText(os.path.join(root, 'cgroup.procs')).split()
+                if procs:
+                    daemonDir = os.path.join(root, DAEMON_CGROUP)
+                    if not os.path.isdir(daemonDir):
+                        os.mkdir(daemonDir)
+                    daemonProcs = os.path.join(daemonDir, 'cgroup.procs')
+                    for pid in procs:
+                        try:
+                            _writeText(daemonProcs, pid)
+                        except IOError, ioe:
+                            if ioe.errno != errno.ESRCH:
+                                raise
+
+            available = _readText(os.path.join(root, 'cgroup.controllers')).split()
+            controllers = [c for c in CGROUP_CONTROLLERS if c in available]
+            if not controllers:
+                raise EnvironmentError(errno.ENOTSUP, 'cgroup %s has none of the %s controllers'
+                                       % (root, ', '.join(CGROUP_CONTROLLERS)))
+            _writeText(os.path.join(root, 'cgroup.subtree_control'),
+                       ' '.join(['+' + c for c in controllers]))
+        except EnvironmentError, err:
+            if self._logger:
+                self._logger.warning('not using cgroups for service limits: %s', err)
+            return False
+
+        self._base = root
+        self._controllers = controllers
+        if self._logger:
+            self._logger.info('using cgroup %s for service limits (controllers: %s)',
+                              root, ' '.join(controllers))
+        return True
+
+    def getControllers(self):
+        return list(self._controllers)
+
+    def getServiceDir(self, name):
+        return os.path.join(self._base, SERVICE_CGROUP_PREFIX + name)
+
+    def prepare(self, name, limits):
+        """
+        Create or update the cgroup for service *name* with *limits*
+        (from parseLimits()). Returns the path of its cgroup.procs file.
+        """
+        cgDir = self.getServiceDir(name)
+        if not os.path.isdir(cgDir):
+            os.mkdir(cgDir)
+        settings = []
+        if 'memory' in self._controllers:
+            settings.append(('memory.max', limits.get('memoryMax')))
+        if 'cpu' in self._controllers:
+            settings.append(('cpu.weight', limits.get('cpuWeight', 100)))
+            cpuQuota = limits.get('cpuQuota')
+            if cpuQuota is not None:
+                cpuQuota = '%d %d' % (int(cpuQuota * CPU_PERIOD_USEC), CPU_PERIOD_USEC)
+            settings.append(('cpu.max', cpuQuota))
+        if 'pids' in self._controllers:
+            settings.append(('pids.max', limits.get('pidsMax')))
+        for fname, value in settings:
+            if value is None:
+                value = 'max'
+            _writeText(os.path.join(cgDir, fname), str(value))
+        return os.path.join(cgDir, 'cgroup.procs')
+
+    def getStats(self, name):
+        """
+        Return usage and event counters of the cgroup of service *name*,
+        or None if it has none.
+        """
+        cgDir = self.getServiceDir(name)
+        if not os.path.isdir(cgDir):
+            return None
+        stats = {}
+        try:
+            stats['cpuStat'] = _readKeyValues(os.path.join(cgDir, 'cpu.stat'))
+            if 'memory' in self._controllers:
+                stats['memoryCurrent'] = int(_readText(os.path.join(cgDir, 'memory.current')))
+                stats['memoryEvents'] = _readKeyValues(os.path.join(cgDir, 'memory.events'))
+            if 'pids' in self._controllers:
+                stats['pidsCurrent'] = int(_readText(os.path.join(cgDir, 'pids.current')))
+        except (IOError, OSError, ValueError):
+            pass
+        return stats
@@ -6,6 +6,12 @@
 
 import os
 import re
+import glob
+import time
+import calendar
+import errno
+import fcntl
+import array
 import datetime
 import pytz
 
@@ -14,10 +20,13 @@ import logging
 import traceback
 
 import gevent
+import gevent.event
+import gevent.socket
 
-from geocamUtil.geventUtil.util import queueFromFile, LineParser
+from geocamUtil.geventUtil.util import LineParser
 
 from geocamPycroraptor2.util import trackerG
+from geocamPycroraptor2 import logindex
 
 
 UNIQUE_REGEX = r'\$\{unique\}|\$unique\b'
@@ -32,6 +41,40 @@ class UtcFormatter(logging.Formatter):
             return dt.isoformat() + 'Z'
 
 
+_timePrefixCache = {}
+
+
+def formatUtcTime(created):
+    """
+    Return the same string as UtcFormatter.formatTime() for a record
+    created at *created*, using a cached per-second prefix instead of
+    building a datetime.
+    """
+    # round the way datetime.utcfromtimestamp() does
+    seconds = int(created)
+    us = int(round((created - seconds) * 1e6))
+    if us == 1000000:
+        seconds += 1
+        us = 0
+    prefix = _timePrefixCache.get(seconds)
+    if prefix is None:
+        prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))
+        _timePrefixCache.clear()
+        _timePrefixCache[seconds] = prefix
+    if us:
+        return '%s.%06dZ' % (prefix, us)
+    else:
+        return prefix + 'Z'
+
+
+def formatLine(created, topic, text):
+    """
+    Format a console line the way UtcFormatter('%(asctime)s %(name)s
+    %(message)s') would format a LogRecord, without creating one.
+    """
+    return '%s %s %s' % (formatUtcTime(created), topic, text)
+
+
 def getFileNameTimeString(timestamp=None):
     if timestamp is None:
         timestamp = datetime.datetime.now(pytz.utc)
@@ -100,6 +143,63 @@ def openLogFromTemplate(owner, fnameTemplate, env):
     return (fname, openLogFromPath(owner, fname))
 
 
+SEGMENT_TIME_REGEX = re.compile(r'(\d{4}-\d\d-\d\d-\d{6})-(\d{6})-UTC')
+
+
+# text and binary (see binlog) segments, plain and compressed
+SEGMENT_SUFFIXES = ('', '.gz', '.bin', '.bin.gz')
+
+
+def getSegmentRegex(fnameTemplate, env, suffixes=SEGMENT_SUFFIXES):
+    """
+    Return a regex matching the base names of log segments created from
+    *fnameTemplate*. Unlike a '*' glob, the ${unique} part must be a
+    segment timestamp, so the segments of service 'foo' don't match
+    those of 'foo_bar'.
+    """
+    marker = '\0'
+    baseName = os.path.basename(_expandUniq(fnameTemplate, marker, env))
+    timePattern = SEGMENT_TIME_REGEX.pattern.replace('(', '(?:')
+    body = timePattern.join([re.escape(part) for part in baseName.split(marker)])
+    suffixPattern = '|'.join([re.escape(suffix) for suffix in suffixes])
+    return re.compile('^%s(?:%s)$' % (body, suffixPattern))
+
+
+def filterSegmentPaths(fnameTemplate, env, paths, suffixes=SEGMENT_SUFFIXES):
+    """
+    Return the paths in *paths* that are log segments created from
+    *fnameTemplate*, leaving out the '_latest'/'_previous' links.
+    """
+    regex = getSegmentRegex(fnameTemplate, env, suffixes)
+    return [path for path in paths
+            if regex.match(os.path.basename(path)) and not os.path.islink(path)]
+
+
+def listSegmentPaths(fnameTemplate, env, suffixes=SEGMENT_SUFFIXES):
+    """
+    Return the paths of all log segments created from *fnameTemplate*,
+    in any format and including compressed ones, but not the
+    '_latest'/'_previous' links.
+    """
+    pattern = _expandUniq(fnameTemplate, '*', env)
+    paths = []
+    for suffix in suffixes:
+        paths += glob.glob(pattern + suffix)
+    return filterSegmentPaths(fnameTemplate, env, paths, suffixes)
+
+
+def getSegmentStartTime(path):
+    """
+    Return the creation time of a log segment (seconds since the epoch),
+    parsed from the ${unique} part of its name, or None.
+    """
+    match = SEGMENT_TIME_REGEX.search(os.path.basename(path))
+    if not match:
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1), '%Y-%m-%d-%H%M%S'))
+    return seconds + int(match.group(2)) * 1e-6
+
+
 class AutoFlushStreamHandler(logging.StreamHandler):
     def emit(self, rec):
         result = super(AutoFlushStreamHandler, self).emit(rec)
@@ -107,35 +207,245 @@ class AutoFlushStreamHandler(logging.StreamHandler):
         return result
 
 
+class LogWriter(object):
+    """
+    Coalesces log lines into large writes to *logFile*. Buffered lines
+    are written when they exceed *maxBufferBytes*, *flushSeconds* after
+    the first line was buffered, or on flush() and close().
+
+    If *rotator* is given (see rotation.LogRotator), after each write
+    the writer asks it whether the file at *path* is due for rotation,
+    and if so switches to a new segment and hands the old one to the
+    rotator to retire.
+
+    If *indexInterval* is set, a sparse time index (see logindex) is
+    written alongside each segment at *path*, with an entry about every
+    *indexInterval* bytes. Index entries come from the *created*
+    timestamps passed to write().
+
+    *segmentHeader*, if given, is written at the start of each segment.
+    """
+
+    def __init__(self, logFile, flushSeconds=0.2, maxBufferBytes=64 * 1024,
+                 path=None, rotator=None, indexInterval=None, segmentHeader=None):
+        self._file = logFile
+        self._segmentHeader = segmentHeader
+        self._path = path
+        self._rotator = rotator
+        self._indexInterval = indexInterval
+        self._index = None
+        self._fileBytes = 0
+        self._fileOpenTime = time.time()
+        self._rotations = 0
+        self._openIndex()
+        self._writeSegmentHeader()
+        self._flushSeconds = flushSeconds
+        self._maxBufferBytes = maxBufferBytes
+        self._buf = []
+        self._bufBytes = 0
+        self._bufLines = 0
+        self._timer = None
+        self._openTime = time.time()
+        self._linesWritten = 0
+        self._bytesWritten = 0
+        self._writeCalls = 0
+
+    def _openIndex(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        if self._indexInterval and self._path:
+            try:
+                self._index = logindex.IndexWriter(logindex.getIndexPath(self._path),
+                                                   self._indexInterval)
+            except IOError:
+                logging.warning('could not open log index for %s', self._path)
+                logging.warning(traceback.format_exc())
+
+    def _writeSegmentHeader(self):
+        if self._segmentHeader:
+            self._file.write(self._segmentHeader)
+            self._fileBytes += len(self._segmentHeader)
+
+    def write(self, text, numLines=1, created=None):
+        if self._index is not None and created is not None:
+            self._index.add(created, self._fileBytes + self._bufBytes)
+        self._buf.append(text)
+        self._bufBytes += len(text)
+        self._bufLines += numLines
+        if self._bufBytes >= self._maxBufferBytes:
+            self.flush()
+        elif self._timer is None:
+            self._timer = gevent.get_hub().loop.timer(self._flushSeconds)
+            # runs in the hub; flush() doesn't block on anything but disk
+            self._timer.start(self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        if not self._buf:
+            return
+        data = ''.join(self._buf)
+        self._linesWritten += self._bufLines
+        self._buf = []
+        self._bufBytes = 0
+        self._bufLines = 0
+        self._file.write(data)
+        self._bytesWritten += len(data)
+        self._fileBytes += len(data)
+        self._writeCalls += 1
+        if self._index is not None:
+            self._index.flush()
+        if (self._rotator is not None
+                and self._rotator.needsRotation(self._fileBytes, self._fileOpenTime)):
+            self._rotate()
+
+    def _rotate(self):
+        try:
+            newPath, newFile = self._rotator.openNext()
+        except:  # pylint: disable=W0702
+            logging.warning('could not open new log segment after %s, not rotating', self._path)
+            logging.warning(traceback.format_exc())
+            # don't retry on every write
+            self._fileOpenTime = time.time()
+            self._fileBytes = 0
+            return
+        self._file.close()
+        oldPath = self._path
+        self._path = newPath
+        self._file = newFile
+        self._fileBytes = 0
+        self._fileOpenTime = time.time()
+        self._rotations += 1
+        self._openIndex()
+        self._writeSegmentHeader()
+        # may be called from a hub timer callback, which must not block
+        gevent.spawn(self._rotator.retire, oldPath)
+
+    def getPath(self):
+        return self._path
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def getStats(self):
+        elapsed = max(time.time() - self._openTime, 1e-6)
+        return dict(linesWritten=self._linesWritten,
+                    bytesWritten=self._bytesWritten,
+                    writeCalls=self._writeCalls,
+                    rotations=self._rotations,
+                    linesPerSecond=self._linesWritten / elapsed,
+                    bytesPerSecond=self._bytesWritten / elapsed)
+
+
+class LogWriterHandler(logging.Handler):
+    def __init__(self, writer):
+        super(LogWriterHandler, self).__init__()
+        self._writer = writer
+
+    def emit(self, rec):
+        try:
+            self._writer.write(self.format(rec) + '\n', created=rec.created)
+        except:  # pylint: disable=W0702
+            self.handleError(rec)
+
+
 class LineBuffer(logging.Handler):
-    def __init__(self, maxSize=2048):
+    """
+    Keeps the most recent formatted log lines in memory, bounded by both
+    line count and total bytes. Storage is preallocated: line text is
+    kept in a circular bytearray, and the timestamp, offset and length
+    of each line in fixed-size circular arrays, so appending is O(1)
+    and a time-based query is a binary search.
+    """
+
+    def __init__(self, maxLines=2048, maxBytes=256 * 1024):
         super(LineBuffer, self).__init__()
-        self._maxSize = maxSize
-        self._lines = []
+        self._maxLines = maxLines
+        self._maxBytes = maxBytes
+        self._data = bytearray(maxBytes)
+        self._times = array.array('d', [0.0]) * maxLines
+        # absolute byte offsets; doubles are exact up to 2**53
+        self._offsets = array.array('d', [0.0]) * maxLines
+        self._lengths = array.array('l', [0]) * maxLines
+        self._first = 0  # absolute index of oldest line
+        self._count = 0
+        self._bytesUsed = 0
+        self._writeOffset = 0
         self._lineCount = 0
 
     def emit(self, rec):
-        DELETE_SIZE = self._maxSize // 2
-        if len(self._lines) == self._maxSize - DELETE_SIZE:
-            del self._lines[0:DELETE_SIZE]
-        # rec.lineCount = self._lineCount
-        self._lines.append(rec)
+        try:
+            self.append(rec.created, self.format(rec))
+        except:  # pylint: disable=W0702
+            self.handleError(rec)
+
+    def _dropOldest(self):
+        slot = self._first % self._maxLines
+        self._bytesUsed -= self._lengths[slot]
+        self._first += 1
+        self._count -= 1
+
+    def append(self, timestamp, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf8')
+        text = text[:self._maxBytes]
+        n = len(text)
+        while self._count and (self._count == self._maxLines
+                               or self._bytesUsed + n > self._maxBytes):
+            self._dropOldest()
+
+        start = self._writeOffset % self._maxBytes
+        firstPart = min(n, self._maxBytes - start)
+        self._data[start:start + firstPart] = text[:firstPart]
+        if firstPart < n:
+            self._data[0:n - firstPart] = text[firstPart:]
+
+        slot = (self._first + self._count) % self._maxLines
+        self._times[slot] = timestamp
+        self._offsets[slot] = self._writeOffset
+        self._lengths[slot] = n
+        self._count += 1
+        self._bytesUsed += n
+        self._writeOffset += n
         self._lineCount += 1
 
+    def _getTime(self, i):
+        return self._times[(self._first + i) % self._maxLines]
+
+    def _getText(self, i):
+        slot = (self._first + i) % self._maxLines
+        start = int(self._offsets[slot]) % self._maxBytes
+        n = self._lengths[slot]
+        end = start + n
+        if end <= self._maxBytes:
+            return str(self._data[start:end])
+        else:
+            return str(self._data[start:] + self._data[:end - self._maxBytes])
+
     def getLines(self, minTime=None, maxLines=None):
-        n = len(self._lines)
+        """
+        Return buffered lines with timestamp >= *minTime*, at most the
+        last *maxLines* of them, oldest first.
+        """
+        lo, hi = 0, self._count
         if minTime:
-            minIndex = n
-            for i in reversed(xrange(0, n)):
-                line = self._lines[i]
-                if line.timestamp < minTime:
-                    minIndex = i + 1
-                    break
-        else:
-            minIndex = 0
+            # find the first line with timestamp >= minTime
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._getTime(mid) < minTime:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        minIndex = lo
         if maxLines:
-            minIndex = max(minIndex, n - maxLines)
-        return self._lines[minIndex:]
+            minIndex = max(minIndex, self._count - maxLines)
+        return [self._getText(i) for i in xrange(minIndex, self._count)]
 
 
 def escapeEndOfLine(line):
@@ -149,6 +459,37 @@ def escapeEndOfLine(line):
         return 'c ' + line
 
 
+END_OF_LINE_REGEX = re.compile(r'\r\n?|\n')
+
+
+def splitLines(data, maxLineLength):
+    """
+    Split console output *data* at '\\n', '\\r\\n' and bare '\\r' into
+    lines escaped by escapeEndOfLine(), cutting lines longer than
+    *maxLineLength* into 'c ' chunks. Returns (lines, partial), where
+    *partial* is the incomplete last line. A trailing '\\r' is kept in
+    *partial* until more data shows whether '\\n' follows it.
+    """
+    result = []
+    start = 0
+    for match in END_OF_LINE_REGEX.finditer(data):
+        if match.group() == '\r' and match.end() == len(data):
+            break
+        end = match.start()
+        while end - start > maxLineLength:
+            result.append('c ' + data[start:start + maxLineLength])
+            start += maxLineLength
+        result.append(escapeEndOfLine(data[start:match.end()]))
+        start = match.end()
+    end = len(data)
+    if data.endswith('\r'):
+        end -= 1
+    while end - start > maxLineLength:
+        result.append('c ' + data[start:start + maxLineLength])
+        start += maxLineLength
+    return result, data[start:]
+
+
 def getStreamLogger(name, stream):
     result = logging.getLogger(name)
     result.setLevel(logging.DEBUG)
@@ -175,22 +516,108 @@ class TimestampingStream(LineParser):
 
 
 class StreamLogger(object):
-    def __init__(self, inFd, logger,
-                 level=logging.DEBUG,
+    """
+    Reads console output from *inFd* in large chunks and calls
+    handleLines(created, texts) with each batch of complete lines,
+    where each text has its end of line escaped by escapeEndOfLine().
+    Lines longer than *maxLineLength* are split. A trailing partial line
+    (such as a prompt) is logged after *partialLineTimeout* seconds
+    without more output.
+
+    If *limiter* (a ratelimit.OutputLimiter) is given, each batch is
+    passed through it, and the reader pauses when it asks for a delay.
+
+    The reader owns *inFd* and closes it at end of file.
+    """
+
+    def __init__(self, inFd, handleLines,
                  maxLineLength=160,
-                 label=None):
-        self._logger = logger
-        self._logger.setLevel(level)
-        self._q = queueFromFile(inFd, maxLineLength, label)
-        self._job = gevent.spawn(self._handleQueue)
+                 label=None,
+                 chunkSize=64 * 1024,
+                 partialLineTimeout=0.1,
+                 limiter=None):
+        self._fd = inFd
+        self._limiter = limiter
+        self._handleLines = handleLines
+        self._maxLineLength = maxLineLength
+        self._label = label
+        self._chunkSize = chunkSize
+        self._partialLineTimeout = partialLineTimeout
+        self._partial = ''
+        self._eof = gevent.event.Event()
+        flags = fcntl.fcntl(inFd, fcntl.F_GETFL)
+        fcntl.fcntl(inFd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._job = gevent.spawn(self._readLoop)
+
+    def _splitLines(self, data):
+        result, self._partial = splitLines(data, self._maxLineLength)
+        return result
 
-    def _handleQueue(self):
-        for line in self._q:
-            self._logger.info(escapeEndOfLine(line))
+    def _flushPartial(self):
+        if self._partial:
+            self._handleLines(time.time(), [escapeEndOfLine(self._partial)])
+            self._partial = ''
+
+    def _read(self):
+        """
+        Returns the next chunk of data, or '' at end of file.
+        """
+        while 1:
+            try:
+                return os.read(self._fd, self._chunkSize)
+            except OSError, oe:
+                if oe.errno == errno.EIO:
+                    # Linux pty master after the slave side is closed
+                    return ''
+                elif oe.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+            if self._partial:
+                try:
+                    gevent.socket.wait_read(self._fd, self._partialLineTimeout)
+                except gevent.socket.timeout:
+                    self._flushPartial()
+            else:
+                gevent.socket.wait_read(self._fd)
+
+    def _readLoop(self):
+        try:
+            while 1:
+                data = self._read()
+                if not data:
+                    break
+                if self._partial:
+                    data = self._partial + data
+                lines = self._splitLines(data)
+                if lines and self._limiter:
+                    lines = self._limiter.limit(lines)
+                if lines:
+                    self._handleLines(time.time(), lines)
+                if self._limiter:
+                    delay = self._limiter.getDelay()
+                    if delay > 0:
+                        # stop reading; the pty buffer fills up and the
+                        # writer blocks
+                        gevent.sleep(delay)
+            self._flushPartial()
+        except gevent.GreenletExit:
+            pass
+        except:  # pylint: disable=W0702
+            logging.warning('%s: error reading console output', self._label)
+            logging.warning(traceback.format_exc())
+        finally:
+            trackerG.close(self._fd)
+            self._eof.set()
+
+    def waitForEof(self, timeout=None):
+        """
+        Wait until all output up to end of file has been logged, or
+        until *timeout* seconds have passed. Returns True if end of file
+        was reached.
+        """
+        return self._eof.wait(timeout)
 
     def stop(self):
         self._job.kill()
-        # could probably more thoroughly flush things
 
 
 class PublishHandler(logging.Handler):
@@ -200,11 +627,11 @@ class PublishHandler(logging.Handler):
 
     def emit(self, record):
         try:
-            if not self._p.hasSubscribers():
+            # event loggers are named like 'service.foo.evt n'
+            topic = record.name.split(' ', 1)[0]
+            if not self._p.hasSubscribers(topic):
                 return
-            text = self.format(record)
-            _, topic, _ = text.split(' ', 2)
-            self._p.publish(topic, text)
+            self._p.publish(topic, self.format(record))
         except:  # pylint: disable=W0702
             logging.warning(traceback.format_exc())
             logging.warning('could not publish message, continuing')
@@ -0,0 +1,228 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Sparse time index for text log segments.
+
+Each segment 'foo_<unique>.txt' may have a sidecar 'foo_<unique>.txt.idx'
+holding fixed-size (timestamp, byte offset) records, one for roughly
+every *intervalBytes* of log text. Each offset is the start of a line
+logged at that timestamp. To extract a time range, a reader
+binary-searches the index, then scans the mmapped segment from the
+nearest offset, so the cost does not grow with the size of the log.
+"""
+
+import os
+import mmap
+import time
+import struct
+import calendar
+
+INDEX_SUFFIX = '.idx'
+INDEX_RECORD = struct.Struct('<dQ')
+DEFAULT_INDEX_INTERVAL = 64 * 1024
+
+# length of '2013-01-01T00:00:00'
+_SECONDS_LEN = 19
+
+_secondsCache = {}
+
+
+def getIndexPath(segmentPath):
+    """
+    Return the index path for *segmentPath*. A compressed segment keeps
+    the index of the uncompressed file.
+    """
+    if segmentPath.endswith('.gz'):
+        segmentPath = segmentPath[:-3]
+    return segmentPath + INDEX_SUFFIX
+
+
+def parseUtcTime(line):
+    """
+    Parse the timestamp at the start of a log line, as written by
+    log.formatUtcTime(). Returns seconds since the epoch, or None if the
+    line doesn't start with a timestamp (for example, a continuation
+    line of a multi-line message).
+    """
+    if len(line) <= _SECONDS_LEN or line[_SECONDS_LEN - 9] != 'T':
+        return None
+    secondsText = line[:_SECONDS_LEN]
+    seconds = _secondsCache.get(secondsText)
+    if seconds is None:
+        try:
+            seconds = calendar.timegm(time.strptime(secondsText, '%Y-%m-%dT%H:%M:%S'))
+        except ValueError:
+            return None
+        if len(_secondsCache) > 1000:
+            _secondsCache.clear()
+        _secondsCache[secondsText] = seconds
+    if line[_SECONDS_LEN] == '.':
+        fraction = line[_SECONDS_LEN + 1:_SECONDS_LEN + 7]
+        try:
+            return seconds + int(fraction) * 1e-6
+        except ValueError:
+            return None
+    return seconds
+
+
+class IndexWriter(object):
+    """
+    Appends index records for a segment. Call add() with the timestamp
+    and file offset of each line (or batch of lines) as it is buffered;
+    a record is kept only when the offset has advanced *intervalBytes*
+    since the last one. Call flush() after the corresponding log text
+    has been written, so the index never points past the end of the
+    segment.
+    """
+
+    def __init__(self, path, intervalBytes=DEFAULT_INDEX_INTERVAL):
+        self._file = open(path, 'ab')
+        self._intervalBytes = intervalBytes
+        self._nextOffset = 0
+        self._pending = []
+
+    def add(self, created, offset):
+        if offset >= self._nextOffset:
+            self._pending.append(INDEX_RECORD.pack(created, offset))
+            self._nextOffset = offset + self._intervalBytes
+
+    def flush(self):
+        if self._pending:
+            self._file.write(''.join(self._pending))
+            self._file.flush()
+            self._pending = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def searchIndex(buf, startTime):
+    """
+    Binary-search the packed index records in *buf* (a string or mmap).
+    Returns the offset of the last record logged before *startTime*, or
+    0 if there is none.
+    """
+    lo = 0
+    hi = len(buf) // INDEX_RECORD.size
+    # find the first record at or after startTime
+    while lo < hi:
+        mid = (lo + hi) // 2
+        t, _offset = INDEX_RECORD.unpack_from(buf, mid * INDEX_RECORD.size)
+        if t < startTime:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == 0:
+        return 0
+    return INDEX_RECORD.unpack_from(buf, (lo - 1) * INDEX_RECORD.size)[1]
+
+
+def findStartOffset(indexPath, startTime):
+    """
+    Return a byte offset in the segment at or before the first line
+    logged at or after *startTime*.
+    """
+    if startTime is None:
+        return 0
+    try:
+        f = open(indexPath, 'rb')
+    except IOError:
+        return 0
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size < INDEX_RECORD.size:
+            return 0
+        buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            return searchIndex(buf, startTime)
+        finally:
+            buf.close()
+    finally:
+        f.close()
+
+
+def iterBufferLines(buf, startOffset=0):
+    """
+    Yield lines (without the newline) from *buf* (a string or mmap),
+    beginning at *startOffset*.
+    """
+    pos = startOffset
+    size = len(buf)
+    while pos < size:
+        end = buf.find('\n', pos)
+        if end == -1:
+            end = size
+        yield buf[pos:end]
+        pos = end + 1
+
+
+def filterTimeRange(lines, startTime=None, endTime=None):
+    """
+    Yield the lines from *lines* whose timestamps fall in [*startTime*,
+    *endTime*]. Lines without a timestamp go with the preceding line.
+    Stops at the first line past *endTime*.
+    """
+    lineTime = None
+    for line in lines:
+        t = parseUtcTime(line)
+        if t is not None:
+            lineTime = t
+        if lineTime is None:
+            # continuation of a line before the start offset
+            continue
+        if startTime is not None and lineTime < startTime:
+            continue
+        if endTime is not None and lineTime > endTime:
+            return
+        yield line
+
+
+def iterLinesInRange(buf, startOffset, startTime=None, endTime=None):
+    """
+    Yield lines from *buf* beginning at *startOffset* whose timestamps
+    fall in [*startTime*, *endTime*].
+    """
+    return filterTimeRange(iterBufferLines(buf, startOffset), startTime, endTime)
+
+
+def readRange(segmentPath, startTime=None, endTime=None, maxBytes=None):
+    """
+    Return (lines, truncated) for lines in *segmentPath* with timestamps
+    in [*startTime*, *endTime*], at most *maxBytes* of them in total.
+    *truncated* is True if the byte limit cut the result short.
+    """
+    segmentPath = os.path.realpath(segmentPath)
+    f = open(segmentPath, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return [], False
+        buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        startOffset = findStartOffset(getIndexPath(segmentPath), startTime)
+        return takeBytes(iterLinesInRange(buf, startOffset, startTime, endTime),
+                         maxBytes)
+    finally:
+        buf.close()
+
+
+def takeBytes(lines, maxBytes=None):
+    """
+    Return (lines, truncated) with lines from *lines* up to *maxBytes*
+    in total, counting a newline after each.
+    """
+    result = []
+    numBytes = 0
+    for line in lines:
+        numBytes += len(line) + 1
+        if maxBytes is not None and numBytes > maxBytes:
+            return result, True
+        result.append(line)
+    return result, False
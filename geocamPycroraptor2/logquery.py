@@ -0,0 +1,172 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Query all log segments of a service as one time-ordered stream.
+
+Segments are ordered by the creation time in their ${unique} names, so
+listing them doesn't require opening them. Only segments that can hold
+lines in the requested time range are opened. Text segments are
+mmapped; compressed segments are decompressed as a stream; binary
+segments (see binlog) are filtered by record timestamp and converted to
+text lines. In all cases the sparse index (see logindex) is used to
+skip to the start time, and matching lines are yielded one at a time.
+"""
+
+import os
+import re
+import gzip
+import mmap
+
+import gevent
+
+from geocamPycroraptor2 import log, logindex, binlog
+
+# give other greenlets a chance to run after scanning this many lines
+YIELD_EVERY_LINES = 10000
+
+
+def listSegments(fnameTemplate, env):
+    """
+    Return [(startTime, path), ...] for the segments of *fnameTemplate*,
+    oldest first. Segments without a parseable time sort first.
+    """
+    result = [(log.getSegmentStartTime(path) or 0, path)
+              for path in log.listSegmentPaths(fnameTemplate, env)]
+    result.sort()
+    return result
+
+
+def selectSegments(segments, startTime=None, endTime=None):
+    """
+    Return the paths of the segments from *segments* (as returned by
+    listSegments()) that can contain lines in [*startTime*, *endTime*].
+    Each segment is assumed to end when the next one starts.
+    """
+    result = []
+    for i, (segmentStart, path) in enumerate(segments):
+        if endTime is not None and segmentStart > endTime:
+            break
+        if startTime is not None and i + 1 < len(segments):
+            nextStart = segments[i + 1][0]
+            if nextStart < startTime:
+                continue
+        result.append(path)
+    return result
+
+
+def getTemplateForPath(path):
+    """
+    Return a file name template matching all segments in the same
+    series as the segment (or '_latest'/'_previous' link) at *path*.
+    """
+    if os.path.islink(path):
+        path = os.path.join(os.path.dirname(path), os.readlink(path))
+    if path.endswith('.gz'):
+        path = path[:-3]
+    if path.endswith(binlog.BINARY_SUFFIX):
+        path = path[:-len(binlog.BINARY_SUFFIX)]
+    dirName, baseName = os.path.split(path)
+    template, n = log.SEGMENT_TIME_REGEX.subn('${unique}', baseName)
+    if not n:
+        raise ValueError('%s is not a pyraptord log segment' % path)
+    return os.path.join(dirName, template)
+
+
+def iterSegmentLines(path, startTime=None):
+    """
+    Yield lines (without the newline) from the segment at *path*,
+    starting near *startTime* if the segment has an index.
+    """
+    startOffset = logindex.findStartOffset(logindex.getIndexPath(path), startTime)
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+        try:
+            f.seek(startOffset)
+            for line in f:
+                yield line.rstrip('\n')
+        finally:
+            f.close()
+        return
+
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        for line in logindex.iterBufferLines(buf, startOffset):
+            yield line
+    finally:
+        buf.close()
+
+
+def _iterTopics(lines):
+    """
+    Yield (topic, line) for each line, where topic is the line's topic
+    field. Lines without a timestamp get the topic of the preceding
+    line.
+    """
+    topic = None
+    for line in lines:
+        if line[:1].isdigit():
+            fields = line.split(' ', 2)
+            if len(fields) >= 2:
+                topic = fields[1]
+        yield topic, line
+
+
+def readRange(path, startTime=None, endTime=None, maxBytes=None):
+    """
+    Return (lines, truncated) for lines in the single segment at *path*
+    with timestamps in [*startTime*, *endTime*], up to *maxBytes* in
+    total. Works for text and binary segments.
+    """
+    if binlog.isBinarySegment(os.path.realpath(path)):
+        return binlog.readRange(path, startTime, endTime, maxBytes)
+    return logindex.readRange(path, startTime, endTime, maxBytes)
+
+
+def queryLog(fnameTemplate, env,
+             startTime=None,
+             endTime=None,
+             topics=None,
+             pattern=None,
+             maxLines=None):
+    """
+    Yield lines from all segments of *fnameTemplate* with timestamps in
+    [*startTime*, *endTime*], oldest first. If *topics* is given, only
+    lines whose topic ends with one of them (for example ['out', 'err'])
+    are returned. If *pattern* is given, only lines matching that
+    regular expression are returned. Stops after *maxLines* lines.
+    """
+    regex = re.compile(pattern) if pattern else None
+    if topics:
+        topics = set(topics)
+    numLines = 0
+    numScanned = 0
+    segments = selectSegments(listSegments(fnameTemplate, env), startTime, endTime)
+    for path in segments:
+        if binlog.isBinarySegment(path):
+            lines = binlog.iterSegmentLines(path, startTime, endTime)
+        else:
+            lines = _iterTopics(logindex.filterTimeRange(iterSegmentLines(path, startTime),
+                                                         startTime, endTime))
+        for topic, line in lines:
+            numScanned += 1
+            if numScanned % YIELD_EVERY_LINES == 0:
+                gevent.sleep(0)
+            if topics and (topic or '').rsplit('.', 1)[-1] not in topics:
+                continue
+            if regex and not regex.search(line):
+                continue
+            yield line
+            numLines += 1
+            if maxLines and numLines >= maxLines:
+                return
@@ -6,6 +6,7 @@
 
 import os
 import sys
+import datetime
 import logging
 import signal
 import shlex
@@ -16,17 +17,31 @@ import gevent
 import gevent.monkey
 gevent.monkey.patch_all(thread=False)
 
-# import zerorpc
-
-# from geocamUtil.geventUtil.qrouter import QueueRouter
+import zerorpc
 
 from geocamPycroraptor2.util import loadConfig, ConfigField
-from geocamPycroraptor2.service import Service
+from geocamPycroraptor2.service import Service, DEFAULT_LOG_NAME
+from geocamPycroraptor2.launcher import GroupLauncher
+from geocamPycroraptor2.spawn import Zygote
+from geocamPycroraptor2.router import TopicRouter
+from geocamPycroraptor2.filewatch import FileWatcher
+from geocamPycroraptor2.statusstore import StatusStore
 from geocamPycroraptor2.signals import SIG_VERBOSE
-from geocamPycroraptor2 import prexceptions, daemonize, log
+from geocamPycroraptor2 import prexceptions, daemonize, log, configdiff, procstats
+from geocamPycroraptor2 import status as statuslib
+from geocamPycroraptor2 import limits as limitslib
 
 # pylint: disable=E1102
 
+# longest getStatusChanges() long-poll, in seconds
+MAX_STATUS_WAIT = 60
+
+
+class _ConfigHolder(object):
+    # lets ConfigField edit a config that isn't Manager._config yet
+    def __init__(self, config):
+        self.config = config
+
 
 class Manager(object):
     """
@@ -50,13 +65,20 @@ class Manager(object):
         self._shutdownCmd = None
         self._preQuitHandler = None
         self._postQuitHandler = None
-        # self._qrouter = QueueRouter()
+        self._qrouter = TopicRouter(self._config.get('SUBSCRIBER_QUEUE_SIZE', 1000))
         self._services = {}
+        self._statusStore = StatusStore()
         self._jobs = []
         self._port = None
         self._ports = None
         self._logPath = None
         self._logFile = None
+        self._zygote = None
+        self._configWatcher = None
+        # runtime setConfig/updateConfig calls, re-applied on reload
+        self._configOverrides = []
+        self._resourceSampler = None
+        self._cgroups = None
 
     def _getSignalsToHandle(self):
         return [signal.SIGHUP, signal.SIGINT, signal.SIGTERM]
@@ -98,6 +120,11 @@ class Manager(object):
             lh.setLevel(logging.DEBUG)
             self._logger.addHandler(lh)
 
+        ph = log.PublishHandler(self._qrouter)
+        ph.setFormatter(fmt)
+        ph.setLevel(logging.DEBUG)
+        self._logger.addHandler(ph)
+
         self._logger.debug('installing signal handlers')
         for sig in self._getSignalsToHandle():
             signal.signal(sig, self._handleSignal)
@@ -112,15 +139,30 @@ class Manager(object):
             daemonize.daemonize('pyraptord', self._logFile,
                                 detachTty=not self._opts.noFork)
 
+        if self._usesZygote():
+            self._zygote = Zygote(self._logger)
+
+        if self._config.get('WATCH_CONFIG', True):
+            self._watchConfig()
+
+        sampleSeconds = self._config.get('RESOURCE_SAMPLE_SECONDS',
+                                         procstats.DEFAULT_SAMPLE_SECONDS)
+        if sampleSeconds:
+            self._resourceSampler = (procstats.ResourceSampler
+                                     (self._getServicePids,
+                                      sampleSeconds=sampleSeconds,
+                                      historyLength=self._config.get('RESOURCE_HISTORY_LENGTH',
+                                                                     procstats.DEFAULT_HISTORY_LENGTH),
+                                      includeChildren=self._config.get('RESOURCE_INCLUDE_CHILDREN',
+                                                                       False)))
+            self._resourceSampler.start()
+
         # start startup services
         if 'startup' in self._config.GROUPS:
-            startupGroup = self._config.GROUPS.startup
-            self._logger.debug('startup group: %s', startupGroup)
-            for svcName in startupGroup:
-                self.startService(svcName)
+            self._logger.debug('startup group: %s', self._config.GROUPS.startup)
+            self._startGroup('startup')
         else:
             self._logger.debug('no group named "startup"')
-        self._jobs.append(gevent.spawn(self._cleanupChildren))
 
     def _handleSignal(self, sigNum='unknown', frame=None):
         if sigNum in SIG_VERBOSE:
@@ -129,6 +171,7 @@ class Manager(object):
             desc = 'unknown'
         self._logger.info('caught signal %s (%s), shutting down',
                           sigNum, desc)
+        self._flushServiceLogs()
         try:
             self.quit()
         except:  # pylint: disable=W0702
@@ -137,33 +180,71 @@ class Manager(object):
             self._logger.warning('now doing a hard exit')
             os._exit(1)
 
+    def _usesZygote(self):
+        if self._config.get('LAUNCH_METHOD') == 'zygote':
+            return True
+        return any([svcConfig.get('launchMethod') == 'zygote'
+                    for svcConfig in self._config.SERVICES.itervalues()])
+
+    def _startGroup(self, groupName):
+        svcNames = self._config.GROUPS.get(groupName)
+        if svcNames is None:
+            raise ValueError('unknown group "%s"' % groupName)
+        concurrency = self._config.get('STARTUP_CONCURRENCY', 8)
+        GroupLauncher(self, svcNames, concurrency).run()
+
+    def _flushServiceLogs(self):
+        for svc in self._services.itervalues():
+            svc.flushLog()
+
+    def _getCgroupManager(self):
+        """
+        Return the CgroupManager for service limits, or None if cgroups
+        are disabled or can't be used here. Set up on first use, so
+        pyraptord leaves cgroups alone unless a service has limits.
+        """
+        if self._cgroups is None:
+            self._cgroups = False
+            if self._config.get('USE_CGROUPS', True):
+                cgroups = limitslib.CgroupManager(self._config.get('CGROUP_ROOT'),
+                                                  self._logger)
+                if cgroups.setup():
+                    self._cgroups = cgroups
+        return self._cgroups or None
+
+    def _getServicePids(self):
+        result = {}
+        for svcName, svc in self._services.iteritems():
+            pid = svc.getPid()
+            if pid is not None:
+                result[svcName] = pid
+        return result
+
     def _getActiveServices(self):
         return [svc
                 for svc in self._services.itervalues()
                 if svc.isActive()]
 
-    def _cleanupChildren(self):
-        while 1:
-            for svc in self._services.itervalues():
-                svc._cleanup()
-            self._checkForQuitComplete()
-            gevent.sleep(0.1)
-
     def _quitInternal(self):
         # leave time to respond to caller before shutting down
         gevent.sleep(0.05)
         self._quitting = True
         if self._preQuitHandler is not None:
             self._preQuitHandler()
+        stopJobs = []
         for svc in self._services.itervalues():
             if svc.isActive():
                 self._logger.info('stopping %s' % svc._name)
-                svc.stop()
+                stopJobs.append(svc.stop())
+        # services stop in parallel; this returns after the longest
+        # grace period at worst
+        gevent.joinall(stopJobs)
         self._checkForQuitComplete()
 
     def _checkForQuitComplete(self):
         if self._quitting and not self._getActiveServices():
             self._logger.info('all services stopped')
+            self._flushServiceLogs()
             if self._postQuitHandler is not None:
                 self._postQuitHandler()
             if self._shutdownCmd is not None:
@@ -204,6 +285,17 @@ class Manager(object):
         self._logger.debug('received: start %s', svcName)
         self._getService(svcName).start()
 
+    def startGroup(self, groupName):
+        """
+        Start all services in group *groupName*. Services start
+        concurrently, except that a service whose config has an 'after'
+        list waits for those services to be running.
+        """
+        self._logger.debug('received: startGroup %s', groupName)
+        if groupName not in self._config.GROUPS:
+            raise ValueError('unknown group "%s"' % groupName)
+        gevent.spawn(self._startGroup, groupName)
+
     def stdin(self, svcName, text):
         """
         Write *text* to the stdin stream for *svcName*.
@@ -230,31 +322,264 @@ class Manager(object):
         """
         return self._getService(svcName).getStatus()
 
+    def getLog(self, svcName, minTime=None, maxLines=None):
+        """
+        Get recent console output and events for *svcName* from memory,
+        as a list of lines in log file format. Only lines with timestamp
+        (seconds since the epoch) >= *minTime* are returned, at most the
+        last *maxLines* of them.
+        """
+        return self._getService(svcName).getLog(minTime, maxLines)
+
+    def readLog(self, svcName, startTime=None, endTime=None, maxBytes=1024 * 1024):
+        """
+        Read lines from the current log file of *svcName* with
+        timestamps (seconds since the epoch) between *startTime* and
+        *endTime*, up to *maxBytes* in total. Uses the log's sparse
+        index to seek to *startTime*. Returns a dict with the segment
+        'path', the 'lines', and whether the result was 'truncated'.
+        """
+        return self._getService(svcName).readLog(startTime, endTime, maxBytes)
+
+    @zerorpc.stream
+    def queryLog(self, svcName, startTime=None, endTime=None, topics=None,
+                 pattern=None, maxLines=None):
+        """
+        Search all log segments of *svcName*, including rotated and
+        compressed ones, for lines with timestamps (seconds since the
+        epoch) between *startTime* and *endTime*. Optionally keep only
+        lines with the given *topics* (a list drawn from 'out', 'err',
+        'inp', 'evt') and lines matching the regular expression
+        *pattern*. Returns a stream of lines, oldest first, ending after
+        *maxLines* lines.
+        """
+        return self._getService(svcName).queryLog(startTime, endTime, topics,
+                                                  pattern, maxLines)
+
+    def getResourceUsage(self, svcName=None, since=None):
+        """
+        Get resource usage sampled from /proc. With *svcName*, returns
+        that service's samples taken after time *since*, as a dict with
+        'fields' and 'samples'. Without, returns the latest sample of
+        every running service, keyed by service name.
+        """
+        sampler = self._resourceSampler
+        if svcName is not None:
+            self._getService(svcName)
+            if sampler is None:
+                return dict(fields=list(procstats.SAMPLE_FIELDS), samples=[])
+            return sampler.getSeries(svcName, since)
+        if sampler is None:
+            return {}
+        result = {}
+        for name in self._getServicePids().iterkeys():
+            latest = sampler.getLatest(name)
+            if latest is not None:
+                result[name] = latest
+        return result
+
     def getStatusAll(self):
         """
-        Get status of all services.
+        Get status of all services. This is served from a snapshot that
+        is only rebuilt when a status changes; use getStatus() for the
+        log and output limit statistics of a single service.
+        """
+        return self._statusStore.getSnapshot()
+
+    def getStatusMany(self, svcNames):
+        """
+        Get status of the services in list *svcNames*, as a dict keyed
+        by service name.
+        """
+        result = {}
+        for svcName in svcNames:
+            if svcName not in self._config.SERVICES:
+                raise prexceptions.UnknownService(svcName)
+            status = self._statusStore.get(svcName)
+            if status is None:
+                status = {'status': statuslib.NOT_STARTED}
+            result[svcName] = status
+        return result
+
+    def getGroupStatus(self, groupName):
+        """
+        Get status of the services in group *groupName*, as a dict keyed
+        by service name.
+        """
+        svcNames = self._config.GROUPS.get(groupName)
+        if svcNames is None:
+            raise ValueError('unknown group "%s"' % groupName)
+        return self.getStatusMany(svcNames)
+
+    def getStatusSince(self, version=0, epoch=None):
+        """
+        Get the status of services whose status changed after status
+        version *version*, without waiting. Returns a dict with the new
+        'version' and 'epoch', and 'changes', mapping service name to
+        status dict (None for a removed service). Pass the returned
+        version and epoch to the next call to poll for changes.
+
+        If *version* and *epoch* come from before pyraptord restarted,
+        'changes' is the status of every service and 'reset' is true;
+        the client should discard what it knows about services that
+        are not listed.
+        """
+        store = self._statusStore
+        if store.isCurrent(version, epoch):
+            changes = store.getChangesSince(version)
+            reset = False
+        else:
+            changes = store.getSnapshot()
+            reset = True
+        return dict(version=store.getVersion(),
+                    epoch=store.getEpoch(),
+                    changes=changes,
+                    reset=reset)
+
+    def getStatusAndConfig(self):
+        """
+        Get status and config of all services in one call. Returns a
+        dict with 'status' (as from getStatusAll()), 'services' (the
+        SERVICES config) and the status 'version' and 'epoch' to pass
+        to getStatusChanges().
+        """
+        return dict(status=self.getStatusAll(),
+                    services=self._config.SERVICES,
+                    version=self._statusStore.getVersion(),
+                    epoch=self._statusStore.getEpoch())
+
+    def getStatusChanges(self, version=0, timeout=0, epoch=None):
+        """
+        Get the status of services whose status changed after status
+        version *version*. If nothing has changed yet, wait up to
+        *timeout* seconds (at most MAX_STATUS_WAIT) for a change.
+        Returns the same dict as getStatusSince().
         """
-        return dict([(svcName, svc.getStatus())
-                     for svcName, svc in self._services.iteritems()])
+        timeout = min(timeout or 0, MAX_STATUS_WAIT)
+        if timeout > 0 and self._statusStore.isCurrent(version, epoch):
+            self._statusStore.waitForChange(version, timeout)
+        return self.getStatusSince(version, epoch)
 
-    def loadConfig(self, path=None):
+    def loadConfig(self, path=None, restartChanged=False, useCache=True):
         """
         Load a new config file from *path* (defaults to the previous
-        config file). Note: you can add or modify services by loading a
-        new config, but you must restart pyraptord if you want to remove
-        unwanted services or change global settings such as the
-        pyraptord zerorpc endpoint.
+        config file) and apply the differences from the current config.
+
+        Services and groups can be added, changed or removed. Removed
+        services are stopped. New config values for a running service
+        take effect the next time it starts; if *restartChanged* is
+        true, running services whose 'command', 'env' or 'cwd' changed
+        are restarted now. Changes to global settings such as LOG_DIR
+        or PORTS still require restarting pyraptord. Changes made with
+        setConfig() and updateConfig() since startup are re-applied on
+        top of the new config.
+
+        If the config file is an executable script, its cached output
+        is used unless the script has changed; pass *useCache* false to
+        run it regardless.
+
+        Returns a description of the changes (see configdiff.diffConfig).
         """
         self._logger.debug('received: loadConfig %s', path)
+        oldPath = self._configPath
         if path is not None:
             self._configPath = os.path.abspath(path)
-        newConfig = loadConfig(self._configPath)
-        for k, v in newConfig.iteritems():
-            if k in self._config and isinstance(v, dict):
-                self._config[k].update(v)
-            else:
-                self._config[k] = v
+        newConfig = loadConfig(self._configPath, useCache)
+        self._applyConfigOverrides(newConfig)
+        diff = self._applyConfig(newConfig, restartChanged)
         self._logger.debug('loaded new config %s', self._configPath)
+        if self._configWatcher is not None and self._configPath != oldPath:
+            self._configWatcher.stop()
+            self._watchConfig()
+        return diff
+
+    def _applyConfigOverrides(self, config):
+        holder = _ConfigHolder(config)
+        overrides = []
+        for op, field, value in self._configOverrides:
+            try:
+                configField = ConfigField(holder, 'config').getSubField(field)
+                if op == 'set':
+                    configField.setValue(value)
+                else:
+                    configField.update(value)
+            except (AttributeError, KeyError, TypeError):
+                self._logger.warning('config reload: dropping runtime change to %s, which no longer applies',
+                                     field)
+                continue
+            overrides.append((op, field, value))
+        self._configOverrides = overrides
+
+    def _applyConfig(self, newConfig, restartChanged=False):
+        diff = configdiff.diffConfig(self._config, newConfig)
+        if configdiff.isEmpty(diff):
+            self._logger.debug('config unchanged')
+            return diff
+
+        services = diff['services']
+        for svcName in services['removed']:
+            svc = self._services.get(svcName)
+            if svc is None:
+                continue
+            # keep the old config around for the stop sequence
+            svc.detachConfig(self._config.SERVICES[svcName])
+            if svc.isActive():
+                gevent.spawn(self._retireService, svcName, svc)
+            else:
+                del self._services[svcName]
+
+        self._config = newConfig
+
+        for svcName in services['removed']:
+            self._statusStore.remove(svcName)
+            if self._resourceSampler is not None:
+                self._resourceSampler.forget(svcName)
+        for svcName in services['added']:
+            if svcName not in self._services:
+                self._statusStore.update(svcName, {'status': statuslib.NOT_STARTED})
+
+        for kind in ('added', 'removed', 'changed'):
+            for section in ('services', 'groups', 'settings'):
+                if diff[section][kind]:
+                    self._logger.info('config reload: %s %s: %s',
+                                      kind, section, ', '.join(diff[section][kind]))
+        if diff['settings']['needsDaemonRestart']:
+            self._logger.warning('config reload: restart pyraptord for changes to %s to take effect',
+                                 ', '.join(diff['settings']['needsDaemonRestart']))
+
+        if restartChanged:
+            for svcName in services['needsRestart']:
+                svc = self._services.get(svcName)
+                if svc is not None and svc.isActive():
+                    self._logger.info('config reload: restarting %s', svcName)
+                    svc.restart()
+        return diff
+
+    def _retireService(self, svcName, svc):
+        self._logger.info('config reload: stopping removed service %s', svcName)
+        try:
+            svc.stop().join()
+        except prexceptions.ServiceNotActive:
+            pass
+        if self._services.get(svcName) is svc:
+            del self._services[svcName]
+            # the stop sequence reported status changes after the removal
+            self._statusStore.remove(svcName)
+
+    def _watchConfig(self):
+        self._configWatcher = FileWatcher(self._configPath, self._handleConfigFileChange)
+        self._configWatcher.start()
+        self._logger.debug('watching config file %s for changes (%s)',
+                           self._configPath, self._configWatcher.method)
+
+    def _handleConfigFileChange(self):
+        self._logger.info('config file %s changed, reloading', self._configPath)
+        try:
+            self.loadConfig(restartChanged=self._config.get('RELOAD_RESTARTS_CHANGED', False))
+        except:  # pylint: disable=W0702
+            self._logger.warning('could not reload config file %s, keeping old config',
+                                 self._configPath)
+            self._logger.warning(traceback.format_exc())
 
     def quit(self):
         """
@@ -300,6 +625,11 @@ class Manager(object):
         """
         configField = ConfigField(self, '_config').getSubField(field)
         configField.setValue(value)
+        # the new value replaces earlier changes to the field
+        self._configOverrides = [override for override in self._configOverrides
+                                 if not (override[1] == field
+                                         or override[1].startswith(field + '.'))]
+        self._configOverrides.append(('set', field, value))
 
     def updateConfig(self, field, valueDict):
         """
@@ -315,6 +645,27 @@ class Manager(object):
         """
         configField = ConfigField(self, '_config').getSubField(field)
         configField.update(valueDict)
+        self._configOverrides.append(('update', field, valueDict))
+
+    def _getLogTemplates(self):
+        """
+        Return (fnameTemplate, env) for every log written to LOG_DIR:
+        the pyraptord log and the log of each service.
+        """
+        result = []
+        if self._logFname is not None:
+            result.append((os.path.join(self._logDir, self._logFname), {}))
+        svcNames = set(self._config.SERVICES.keys()) | set(self._services.keys())
+        for svcName in sorted(svcNames):
+            svc = self._services.get(svcName)
+            if svc is not None:
+                logName = svc.getLogNameTemplate()
+            else:
+                logName = self._config.SERVICES[svcName].get('log', DEFAULT_LOG_NAME)
+            if logName is not None:
+                result.append((os.path.join(self._logDir, logName),
+                               {'name': svcName}))
+        return result
 
     def getServiceConfig(self, svcName):
         """
@@ -334,53 +685,73 @@ class Manager(object):
         """
         self.updateConfig('SERVICES.' + svcName, valueDict)
 
-    # @zerorpc.stream
-    # def subscribe(self, topicPattern):
-    #     """
-    #     Subscribe to messages whose topic matches *topicPattern*, which
-    #     is a string that can include Unix shell-style wildcards.
-
-    #     This method returns an infinite message stream you can iterate
-    #     through.
-
-    #     The first message in the stream is the integer *subscriptionId*
-    #     which can be passed later to the unsubscribe() method.
-    #     Subsequent messages in the stream will be strings in the same
-    #     format as lines in pyraptord log files. (The second entry in a
-    #     log file line is the topic.)
-
-    #     Example topic patterns:
-
-    #     '*': All messages
-    #     'service.foo.*': All messages about service 'foo'
-    #     'service.foo.out': Stdout console output from service 'foo'
-    #     'service.foo.err': Stderr console output from service 'foo'
-    #     'service.foo.inp': Stdin console input to service 'foo'
-    #     'service.foo.evt': Events for service 'foo' (start, stop, etc)
-    #     """
-    #     q = None
-    #     try:
-    #         q = self._qrouter.subscribe(topicPattern)
-    #         yield id(q)
-    #         for _topic, msg in q:
-    #             yield msg
-    #     finally:
-    #         if q:
-    #             self._logger.info('cleaning up subscription to %s', topicPattern)
-    #             self._qrouter.unsubscribe(q)
-
-    # def unsubscribe(self, subscriptionId):
-    #     """
-    #     Stop receiving messages for the subscription with the given
-    #     *subscriptionId*.
-
-    #     You can find the *subscriptionId* in the stream returned by the
-    #     subscribe() call; it is the first value in the stream.
-    #     """
-    #     topicPattern, q = self._qrouter.getQueueInfo(subscriptionId)
-    #     self._logger.info('subscriber explicitly unsubscribed from %s',
-    #                       topicPattern)
-    #     # sending StopIteration signals the end of the stream to the
-    #     # client side and triggers the 'finally' clause in the
-    #     # subscribe() method to clean up.
-    #     q.put(StopIteration)
+    @zerorpc.stream
+    def subscribe(self, topicPattern):
+        """
+        Subscribe to messages whose topic matches *topicPattern*, which
+        is a dot-separated string that can include Unix shell-style
+        wildcards within each segment. A trailing '*' segment matches
+        all remaining segments.
+
+        This method returns an infinite message stream you can iterate
+        through.
+
+        The first message in the stream is the integer *subscriptionId*
+        which can be passed later to the unsubscribe() method.
+        Subsequent messages in the stream will be strings in the same
+        format as lines in pyraptord log files. (The second entry in a
+        log file line is the topic.)
+
+        If the subscriber falls too far behind (SUBSCRIBER_QUEUE_SIZE
+        messages), new messages are dropped and a pyraptord.evt message
+        in the stream reports how many were lost.
+
+        Example topic patterns:
+
+        '*': All messages
+        'service.foo.*': All messages about service 'foo'
+        'service.foo.out': Stdout console output from service 'foo'
+        'service.foo.err': Stderr console output from service 'foo'
+        'service.foo.inp': Stdin console input to service 'foo'
+        'service.foo.evt': Events for service 'foo' (start, stop, etc)
+        'service.*.evt': Events for all services
+        """
+        q = None
+        try:
+            q = self._qrouter.subscribe(topicPattern)
+            yield q.id
+            reportedDrops = 0
+            for _topic, msg in q:
+                if q.dropped != reportedDrops:
+                    yield ('%sZ pyraptord.evt n subscription %s dropped %s messages'
+                           % (datetime.datetime.utcnow().isoformat(), q.id,
+                              q.dropped - reportedDrops))
+                    reportedDrops = q.dropped
+                yield msg
+        finally:
+            if q:
+                self._logger.info('cleaning up subscription to %s', topicPattern)
+                self._qrouter.unsubscribe(q)
+
+    def unsubscribe(self, subscriptionId):
+        """
+        Stop receiving messages for the subscription with the given
+        *subscriptionId*.
+
+        You can find the *subscriptionId* in the stream returned by the
+        subscribe() call; it is the first value in the stream.
+        """
+        topicPattern, q = self._qrouter.getQueueInfo(subscriptionId)
+        self._logger.info('subscriber explicitly unsubscribed from %s',
+                          topicPattern)
+        # ending the queue signals the end of the stream to the client
+        # side and triggers the 'finally' clause in the subscribe()
+        # method to clean up.
+        q.close()
+
+    def getSubscriptions(self):
+        """
+        Get info about active subscriptions, including counts of
+        delivered and dropped messages.
+        """
+        return self._qrouter.getSubscriptions()
@@ -0,0 +1,278 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Resource usage of managed processes, sampled from /proc.
+"""
+
+import os
+import time
+import logging
+import traceback
+from collections import deque
+
+import gevent
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+DEFAULT_SAMPLE_SECONDS = 1.0
+DEFAULT_HISTORY_LENGTH = 300
+
+# fields of a sample, in the order they are stored in the series
+SAMPLE_FIELDS = ('timestamp', 'cpuPercent', 'cpuSeconds', 'rssBytes', 'vmBytes',
+                 'numThreads', 'numFds', 'readBytes', 'writeBytes', 'numProcs')
+
+
+def _parseStat(text):
+    """
+    Return (ppid, cpuTicks, numThreads, startTicks) from the contents of
+    /proc/<pid>/stat.
+    """
+    # the command name may contain spaces and parens; skip past it
+    fields = text[text.rindex(')') + 2:].split()
+    # fields[0] is field 3 (state) in proc(5)
+    ppid = int(fields[1])
+    cpuTicks = int(fields[11]) + int(fields[12])
+    numThreads = int(fields[17])
+    startTicks = int(fields[19])
+    return ppid, cpuTicks, numThreads, startTicks
+
+
+def _parseIo(text):
+    readBytes = writeBytes = 0
+    for line in text.splitlines():
+        if line.startswith('read_bytes:'):
+            readBytes = int(line.split()[1])
+        elif line.startswith('write_bytes:'):
+            writeBytes = int(line.split()[1])
+    return readBytes, writeBytes
+
+
+def _reread(f):
+    f.seek(0)
+    return f.read()
+
+
+def getChildMap():
+    """
+    Return {ppid: [pid, ...]} for all processes on the host.
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                ppid = _parseStat(f.read())[0]
+        except (IOError, OSError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+
+def getDescendants(pid, childMap):
+    result = []
+    pending = list(childMap.get(pid, []))
+    while pending:
+        child = pending.pop()
+        result.append(child)
+        pending.extend(childMap.get(child, []))
+    return result
+
+
+class ProcReader(object):
+    """
+    Reads the resource usage of process *pid*. The /proc files are
+    opened once and re-read from the start on every call to read(), so
+    a sample costs a few read() calls rather than a few open() calls.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self._stat = open('/proc/%d/stat' % pid)
+        self._statm = open('/proc/%d/statm' % pid)
+        try:
+            self._io = open('/proc/%d/io' % pid)
+        except IOError:
+            # io is only readable by the process owner (or root)
+            self._io = None
+        self._fdDir = '/proc/%d/fd' % pid
+        self.startTicks = None
+
+    def read(self):
+        """
+        Return a dict of current usage. Raises IOError or OSError if the
+        process no longer exists.
+        """
+        _ppid, cpuTicks, numThreads, startTicks = _parseStat(_reread(self._stat))
+        if self.startTicks is None:
+            self.startTicks = startTicks
+        elif startTicks != self.startTicks:
+            # pid was reused by a different process
+            raise OSError('process %d was replaced' % self.pid)
+        statm = _reread(self._statm).split()
+        if self._io is not None:
+            readBytes, writeBytes = _parseIo(_reread(self._io))
+        else:
+            readBytes = writeBytes = 0
+        try:
+            numFds = len(os.listdir(self._fdDir))
+        except OSError:
+            numFds = 0
+        return dict(cpuTicks=cpuTicks,
+                    vmBytes=int(statm[0]) * PAGE_SIZE,
+                    rssBytes=int(statm[1]) * PAGE_SIZE,
+                    numThreads=numThreads,
+                    numFds=numFds,
+                    readBytes=readBytes,
+                    writeBytes=writeBytes)
+
+    def close(self):
+        for f in (self._stat, self._statm, self._io):
+            if f is not None:
+                f.close()
+
+
+class ResourceSampler(object):
+    """
+    Samples the resource usage of running services every
+    *sampleSeconds*. *getPids()* should return {name: pid} for the
+    services to sample. If *includeChildren* is set, each service's
+    usage includes its descendant processes.
+
+    The last *historyLength* samples of each service are kept as tuples
+    with SAMPLE_FIELDS.
+    """
+
+    def __init__(self, getPids, sampleSeconds=DEFAULT_SAMPLE_SECONDS,
+                 historyLength=DEFAULT_HISTORY_LENGTH, includeChildren=False):
+        self._getPids = getPids
+        self._sampleSeconds = sampleSeconds
+        self._historyLength = historyLength
+        self._includeChildren = includeChildren
+        self._readers = {}  # pid -> ProcReader
+        self._prevCpu = {}  # name -> (timestamp, cpuTicks)
+        self._series = {}  # name -> deque of samples
+        self._job = None
+
+    def start(self):
+        self._job = gevent.spawn(self._sampleLoop)
+
+    def stop(self):
+        if self._job is not None:
+            self._job.kill()
+            self._job = None
+        for reader in self._readers.itervalues():
+            reader.close()
+        self._readers = {}
+
+    def _sampleLoop(self):
+        while 1:
+            try:
+                self.sample()
+            except:  # pylint: disable=W0702
+                logging.warning('error sampling resource usage')
+                logging.warning(traceback.format_exc())
+            gevent.sleep(self._sampleSeconds)
+
+    def _readPid(self, pid):
+        reader = self._readers.get(pid)
+        try:
+            if reader is None:
+                reader = ProcReader(pid)
+                self._readers[pid] = reader
+            return reader.read()
+        except (IOError, OSError, ValueError):
+            if reader is not None:
+                reader.close()
+                del self._readers[pid]
+            return None
+
+    def sample(self):
+        """
+        Take one sample of every service.
+        """
+        now = time.time()
+        pids = self._getPids()
+        childMap = getChildMap() if self._includeChildren else {}
+        seen = set()
+        for name, pid in pids.iteritems():
+            procPids = [pid]
+            if self._includeChildren:
+                procPids += getDescendants(pid, childMap)
+            total = None
+            numProcs = 0
+            for procPid in procPids:
+                usage = self._readPid(procPid)
+                if usage is None:
+                    continue
+                seen.add(procPid)
+                numProcs += 1
+                if total is None:
+                    total = usage
+                else:
+                    for key, value in usage.iteritems():
+                        total[key] += value
+            if total is None:
+                continue
+            self._addSample(name, now, total, numProcs)
+
+        # close handles of processes that exited or left the tree
+        for pid in self._readers.keys():
+            if pid not in seen:
+                self._readers.pop(pid).close()
+        for name in self._prevCpu.keys():
+            if name not in pids:
+                del self._prevCpu[name]
+
+    def _addSample(self, name, now, usage, numProcs):
+        cpuTicks = usage['cpuTicks']
+        prev = self._prevCpu.get(name)
+        cpuPercent = 0.0
+        if prev is not None and now > prev[0] and cpuTicks >= prev[1]:
+            cpuPercent = (100.0 * (cpuTicks - prev[1]) / CLOCK_TICKS
+                          / (now - prev[0]))
+        self._prevCpu[name] = (now, cpuTicks)
+
+        series = self._series.get(name)
+        if series is None:
+            series = deque(maxlen=self._historyLength)
+            self._series[name] = series
+        series.append((now,
+                       round(cpuPercent, 1),
+                       float(cpuTicks) / CLOCK_TICKS,
+                       usage['rssBytes'],
+                       usage['vmBytes'],
+                       usage['numThreads'],
+                       usage['numFds'],
+                       usage['readBytes'],
+                       usage['writeBytes'],
+                       numProcs))
+
+    def getLatest(self, name):
+        """
+        Return the latest sample of service *name* as a dict, or None.
+        """
+        series = self._series.get(name)
+        if not series:
+            return None
+        return dict(zip(SAMPLE_FIELDS, series[-1]))
+
+    def getSeries(self, name, since=None):
+        """
+        Return the samples of service *name* taken after time *since* as
+        a dict with 'fields' (SAMPLE_FIELDS) and 'samples' (a list of
+        lists of values).
+        """
+        series = self._series.get(name) or ()
+        samples = [list(s) for s in series
+                   if since is None or s[0] > since]
+        return dict(fields=list(SAMPLE_FIELDS), samples=samples)
+
+    def forget(self, name):
+        self._series.pop(name, None)
+        self._prevCpu.pop(name, None)
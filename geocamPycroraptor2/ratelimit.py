@@ -0,0 +1,147 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import time
+
+# how often to log a summary while output is being suppressed
+SUPPRESSED_REPORT_SECONDS = 1.0
+
+
+class TokenBucket(object):
+    """
+    Token bucket that refills at *rate* tokens per second up to
+    *capacity*. The balance may go negative (debt), which is paid off
+    by waiting.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self._lastTime = time.time()
+
+    def refill(self, now):
+        elapsed = now - self._lastTime
+        self._lastTime = now
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    def getDelay(self):
+        """
+        Seconds until the balance is non-negative again.
+        """
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class OutputLimiter(object):
+    """
+    Limits the console output of a service to *linesPerSecond* and
+    *bytesPerSecond* (either may be None for no limit), allowing bursts
+    of up to *burstSeconds* worth of output.
+
+    In 'drop' mode, lines over the limit are discarded and counted, and
+    reportSuppressed(numLines) is called at most once a second (and by
+    reportPending()) so the log shows what was lost.
+
+    In 'block' mode, nothing is dropped; instead getDelay() tells the
+    reader how long to stop reading, which lets the kernel pty buffer
+    fill and blocks the writing process.
+    """
+
+    def __init__(self, linesPerSecond=None, bytesPerSecond=None,
+                 burstSeconds=1.0, mode='drop', reportSuppressed=None):
+        if mode not in ('drop', 'block'):
+            raise ValueError('output limit mode should be "drop" or "block", got %s' % mode)
+        self._buckets = []
+        self._lineBucket = None
+        self._byteBucket = None
+        if linesPerSecond:
+            self._lineBucket = TokenBucket(linesPerSecond, linesPerSecond * burstSeconds)
+            self._buckets.append(self._lineBucket)
+        if bytesPerSecond:
+            self._byteBucket = TokenBucket(bytesPerSecond, bytesPerSecond * burstSeconds)
+            self._buckets.append(self._byteBucket)
+        self._block = (mode == 'block')
+        self._reportSuppressed = reportSuppressed
+        self._pendingSuppressed = 0
+        self._lastReportTime = 0
+        self.admittedLines = 0
+        self.admittedBytes = 0
+        self.suppressedLines = 0
+        self.suppressedBytes = 0
+        self.blockedSeconds = 0.0
+
+    def limit(self, lines):
+        """
+        Return the lines from *lines* that may be logged now.
+        """
+        now = time.time()
+        for bucket in self._buckets:
+            bucket.refill(now)
+        lineBucket = self._lineBucket
+        byteBucket = self._byteBucket
+
+        if self._block:
+            numBytes = sum([len(line) for line in lines])
+            if lineBucket:
+                lineBucket.tokens -= len(lines)
+            if byteBucket:
+                byteBucket.tokens -= numBytes
+            self.admittedLines += len(lines)
+            self.admittedBytes += numBytes
+            return lines
+
+        result = []
+        for line in lines:
+            n = len(line)
+            if ((lineBucket is None or lineBucket.tokens >= 1)
+                    and (byteBucket is None or byteBucket.tokens >= n)):
+                if lineBucket:
+                    lineBucket.tokens -= 1
+                if byteBucket:
+                    byteBucket.tokens -= n
+                self.admittedLines += 1
+                self.admittedBytes += n
+                result.append(line)
+            else:
+                self.suppressedLines += 1
+                self.suppressedBytes += n
+                self._pendingSuppressed += 1
+
+        if (self._pendingSuppressed
+                and now - self._lastReportTime >= SUPPRESSED_REPORT_SECONDS):
+            self.reportPending()
+        return result
+
+    def reportPending(self):
+        """
+        Report lines suppressed since the last report, if any.
+        """
+        if self._pendingSuppressed and self._reportSuppressed:
+            self._reportSuppressed(self._pendingSuppressed)
+        self._pendingSuppressed = 0
+        self._lastReportTime = time.time()
+
+    def getDelay(self):
+        """
+        In block mode, seconds the reader should wait before reading
+        more output.
+        """
+        if not self._block:
+            return 0
+        delay = max([bucket.getDelay() for bucket in self._buckets] + [0])
+        self.blockedSeconds += delay
+        return delay
+
+    def getStats(self):
+        return dict(mode='block' if self._block else 'drop',
+                    admittedLines=self.admittedLines,
+                    admittedBytes=self.admittedBytes,
+                    suppressedLines=self.suppressedLines,
+                    suppressedBytes=self.suppressedBytes,
+                    blockedSeconds=self.blockedSeconds)
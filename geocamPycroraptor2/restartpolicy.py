@@ -0,0 +1,56 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Automatic restart of services that exit on their own.
+"""
+
+from geocamPycroraptor2 import status as statuslib
+
+ALWAYS = 'always'
+ON_FAILURE = 'on-failure'
+NEVER = 'never'
+
+RESTART_POLICIES = (ALWAYS, ON_FAILURE, NEVER)
+
+# exit statuses that count as failures for the on-failure policy
+FAILURE_STATUS = (statuslib.FAILED,
+                  statuslib.SEGFAULT,
+                  statuslib.ABORTED)
+
+
+def checkPolicy(policy):
+    if policy not in RESTART_POLICIES:
+        raise ValueError('restart should be one of %s, got %s'
+                         % (', '.join(RESTART_POLICIES), policy))
+    return policy
+
+
+def shouldRestart(policy, status):
+    """
+    Return True if a service with restart policy *policy* should be
+    restarted after exiting with *status*.
+    """
+    if policy == ALWAYS:
+        return True
+    elif policy == ON_FAILURE:
+        return status in FAILURE_STATUS
+    else:
+        return False
+
+
+def getRestartDelay(attempt, baseSeconds, maxSeconds, burst):
+    """
+    Return the delay in seconds before restart number *attempt* (counting
+    from 1) of a crash loop. The first *burst* restarts happen right
+    away; after that the delay starts at *baseSeconds* and doubles with
+    each attempt, up to *maxSeconds*.
+    """
+    if attempt <= burst:
+        return 0
+    # cap the exponent; the delay is capped anyway
+    exponent = min(attempt - burst - 1, 30)
+    return min(maxSeconds, baseSeconds * 2 ** exponent)
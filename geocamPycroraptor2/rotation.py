@@ -0,0 +1,204 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import os
+import gzip
+import time
+import shutil
+import logging
+import traceback
+
+import gevent
+
+from geocamPycroraptor2 import log, logindex
+
+COMPRESSED_SUFFIX = '.gz'
+
+
+def compressFile(path):
+    """
+    Gzip *path* to *path*.gz, preserving its modification time, and
+    remove the original. Returns the new path.
+    """
+    outPath = path + COMPRESSED_SUFFIX
+    tmpPath = outPath + '.tmp'
+    stat = os.stat(path)
+    inFile = open(path, 'rb')
+    try:
+        outFile = gzip.open(tmpPath, 'wb')
+        try:
+            shutil.copyfileobj(inFile, outFile, 1024 * 1024)
+        finally:
+            outFile.close()
+    finally:
+        inFile.close()
+    os.utime(tmpPath, (stat.st_atime, stat.st_mtime))
+    os.rename(tmpPath, outPath)
+    os.unlink(path)
+    return outPath
+
+
+def getProtectedPaths(logDir):
+    """
+    Return the paths of files that are the target of a symlink in
+    *logDir*, and their index files. These include every log that is
+    currently being written (the '_latest' links), so retention never
+    deletes them.
+    """
+    result = set()
+    for name in os.listdir(logDir):
+        path = os.path.join(logDir, name)
+        if os.path.islink(path):
+            target = os.path.join(logDir, os.readlink(path))
+            result.add(target)
+            result.add(logindex.getIndexPath(target))
+    return result
+
+
+def _deleteOldest(paths, protected, maxBytes, maxFiles):
+    # each segment's size includes its index; both are deleted together
+    entries = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # deleted under us
+        size = stat.st_size
+        indexPath = logindex.getIndexPath(path)
+        if indexPath != path:
+            try:
+                size += os.stat(indexPath).st_size
+            except OSError:
+                pass
+        entries.append((stat.st_mtime, path, size))
+    entries.sort()
+    totalBytes = sum([size for _mtime, _path, size in entries])
+    numFiles = len(entries)
+    for _mtime, path, size in entries:
+        if ((maxBytes is None or totalBytes <= maxBytes)
+                and (maxFiles is None or numFiles <= maxFiles)):
+            break
+        if path in protected:
+            continue
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        totalBytes -= size
+        numFiles -= 1
+        indexPath = logindex.getIndexPath(path)
+        if indexPath != path and os.path.exists(indexPath):
+            try:
+                os.unlink(indexPath)
+            except OSError:
+                pass
+
+
+class LogRotator(object):
+    """
+    Decides when a service log should be rotated and cleans up after
+    rotation. Rotated segments are gzipped and retention limits are
+    enforced in the gevent hub's thread pool, off the event loop.
+
+    Retention limits: *maxLogBytes* and *maxLogFiles* apply to the log
+    segments of this service, in any format; *maxLogDirBytes* applies to
+    the segments of all logs in *logDirTemplates*, a list of
+    (fnameTemplate, env) covering every log pyraptord writes. Other
+    files in the log directory are left alone. New segments are named
+    from *fnameTemplate* plus *suffix*.
+    """
+
+    def __init__(self, owner, fnameTemplate, env,
+                 rotateBytes=None,
+                 rotateSeconds=None,
+                 compress=True,
+                 maxLogBytes=None,
+                 maxLogFiles=None,
+                 maxLogDirBytes=None,
+                 logDirTemplates=None,
+                 suffix=''):
+        self._owner = owner
+        self._fnameTemplate = fnameTemplate
+        self._suffix = suffix
+        self._env = env
+        self._rotateBytes = rotateBytes
+        self._rotateSeconds = rotateSeconds
+        self._compress = compress
+        self._maxLogBytes = maxLogBytes
+        self._maxLogFiles = maxLogFiles
+        self._maxLogDirBytes = maxLogDirBytes
+        if logDirTemplates is None:
+            logDirTemplates = [(fnameTemplate, env)]
+        self._logDirTemplates = logDirTemplates
+
+    def hasRetentionLimits(self):
+        return (self._maxLogBytes is not None
+                or self._maxLogFiles is not None
+                or self._maxLogDirBytes is not None)
+
+    def needsRotation(self, fileBytes, openTime):
+        if self._rotateBytes and fileBytes >= self._rotateBytes:
+            return True
+        if self._rotateSeconds and time.time() - openTime >= self._rotateSeconds:
+            return True
+        return False
+
+    def openNext(self):
+        """
+        Open a new log segment and point the '_latest' link at it.
+        Returns (path, file).
+        """
+        return log.openLogFromTemplate(self._owner, self._fnameTemplate + self._suffix,
+                                       self._env)
+
+    def retire(self, oldPath):
+        """
+        Compress *oldPath* and enforce retention limits in the
+        background.
+        """
+        gevent.get_hub().threadpool.spawn(self._retire, oldPath)
+
+    def enforceRetention(self):
+        if self.hasRetentionLimits():
+            gevent.get_hub().threadpool.spawn(self._enforceRetention)
+
+    def getSegmentPaths(self):
+        return log.listSegmentPaths(self._fnameTemplate, self._env)
+
+    def getLogDirSegmentPaths(self):
+        paths = set()
+        for fnameTemplate, env in self._logDirTemplates:
+            paths.update(log.listSegmentPaths(fnameTemplate, env))
+        return sorted(paths)
+
+    def _retire(self, oldPath):
+        # runs in a worker thread
+        try:
+            if self._compress:
+                newPath = compressFile(oldPath)
+                previousLink = log._expandUniq(self._fnameTemplate + self._suffix,
+                                               'previous', self._env)
+                if (os.path.islink(previousLink)
+                        and os.readlink(previousLink) == os.path.basename(oldPath)):
+                    os.unlink(previousLink)
+                    os.symlink(os.path.basename(newPath), previousLink)
+            self._enforceRetention()
+        except:  # pylint: disable=W0702
+            logging.warning('%s: error retiring log segment %s', self._owner, oldPath)
+            logging.warning(traceback.format_exc())
+
+    def _enforceRetention(self):
+        # runs in a worker thread
+        if not self.hasRetentionLimits():
+            return
+        logDir = os.path.dirname(log._expandUniq(self._fnameTemplate, 'latest', self._env))
+        protected = getProtectedPaths(logDir)
+        if self._maxLogBytes is not None or self._maxLogFiles is not None:
+            _deleteOldest(self.getSegmentPaths(), protected,
+                          self._maxLogBytes, self._maxLogFiles)
+        if self._maxLogDirBytes is not None:
+            _deleteOldest(self.getLogDirSegmentPaths(), protected,
+                          self._maxLogDirBytes, None)
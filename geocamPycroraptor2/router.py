@@ -0,0 +1,171 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import fnmatch
+import itertools
+
+import gevent.queue
+
+GLOB_CHARS = '*?['
+
+
+class Subscription(object):
+    """
+    A subscriber queue. Messages are dropped (and counted) rather than
+    queued when the subscriber falls more than *maxQueueSize* messages
+    behind, so a slow client can't stall publishers.
+    """
+
+    def __init__(self, subscriptionId, topicPattern, maxQueueSize):
+        self.id = subscriptionId
+        self.topicPattern = topicPattern
+        self.maxQueueSize = maxQueueSize
+        self.dropped = 0
+        self.delivered = 0
+        self._q = gevent.queue.Queue()
+
+    def put(self, topic, msg):
+        if self._q.qsize() >= self.maxQueueSize:
+            self.dropped += 1
+        else:
+            self._q.put((topic, msg))
+            self.delivered += 1
+
+    def close(self):
+        # the queue is unbounded, so this never blocks
+        self._q.put(StopIteration)
+
+    def __iter__(self):
+        return iter(self._q)
+
+    def getInfo(self):
+        return dict(id=self.id,
+                    topicPattern=self.topicPattern,
+                    queued=self._q.qsize(),
+                    delivered=self.delivered,
+                    dropped=self.dropped)
+
+
+class _TrieNode(object):
+    def __init__(self):
+        self.exact = {}   # literal segment -> node
+        self.globs = {}   # wildcard segment -> node
+        self.subs = set()  # subscriptions whose pattern ends here
+        self.rest = set()  # patterns ending here with a trailing '*'
+
+    def isEmpty(self):
+        return not (self.exact or self.globs or self.subs or self.rest)
+
+
+class TopicRouter(object):
+    """
+    Routes messages to subscribers by dot-separated topic, such as
+    'service.foo.out'. Topic patterns use Unix shell-style wildcards
+    within each dot-separated segment. A trailing '*' segment matches
+    one or more remaining segments, so 'service.foo.*' matches all
+    topics for service 'foo' and '*' matches everything.
+
+    Patterns are kept in a trie keyed by segment. Matching a topic only
+    visits trie branches that can match, and the subscriber set for
+    each topic is cached until the next subscription change.
+    """
+
+    def __init__(self, maxQueueSize=1000):
+        self._maxQueueSize = maxQueueSize
+        self._root = _TrieNode()
+        self._subscriptions = {}
+        self._matchCache = {}
+        self._ids = itertools.count(1)
+
+    def hasSubscribers(self, topic=None):
+        if topic is None:
+            return bool(self._subscriptions)
+        return bool(self._match(topic))
+
+    def subscribe(self, topicPattern):
+        sub = Subscription(self._ids.next(), topicPattern, self._maxQueueSize)
+        segments = topicPattern.split('.')
+        node = self._root
+        for segment in segments[:-1]:
+            node = self._getChild(node, segment)
+        last = segments[-1]
+        if last == '*':
+            node.rest.add(sub)
+        else:
+            self._getChild(node, last).subs.add(sub)
+        self._subscriptions[sub.id] = sub
+        self._matchCache = {}
+        return sub
+
+    def unsubscribe(self, sub):
+        if self._subscriptions.pop(sub.id, None) is None:
+            return
+        segments = sub.topicPattern.split('.')
+        path = [self._root]
+        for segment in segments[:-1]:
+            path.append(self._lookupChild(path[-1], segment))
+        last = segments[-1]
+        if last == '*':
+            path[-1].rest.discard(sub)
+        else:
+            path.append(self._lookupChild(path[-1], last))
+            path[-1].subs.discard(sub)
+        # prune empty branches
+        for i in xrange(len(path) - 1, 0, -1):
+            if not path[i].isEmpty():
+                break
+            parent = path[i - 1]
+            segment = segments[i - 1]
+            parent.exact.pop(segment, None)
+            parent.globs.pop(segment, None)
+        self._matchCache = {}
+
+    def getQueueInfo(self, subscriptionId):
+        sub = self._subscriptions[subscriptionId]
+        return sub.topicPattern, sub
+
+    def getSubscriptions(self):
+        return [sub.getInfo() for sub in self._subscriptions.itervalues()]
+
+    def publish(self, topic, msg):
+        for sub in self._match(topic):
+            sub.put(topic, msg)
+
+    def _getChild(self, node, segment):
+        if any([c in segment for c in GLOB_CHARS]):
+            table = node.globs
+        else:
+            table = node.exact
+        child = table.get(segment)
+        if child is None:
+            child = _TrieNode()
+            table[segment] = child
+        return child
+
+    def _lookupChild(self, node, segment):
+        return node.exact.get(segment) or node.globs.get(segment)
+
+    def _match(self, topic):
+        result = self._matchCache.get(topic)
+        if result is None:
+            result = set()
+            self._collect(self._root, topic.split('.'), 0, result)
+            result = tuple(result)
+            self._matchCache[topic] = result
+        return result
+
+    def _collect(self, node, segments, i, result):
+        if i == len(segments):
+            result.update(node.subs)
+            return
+        result.update(node.rest)
+        segment = segments[i]
+        child = node.exact.get(segment)
+        if child is not None:
+            self._collect(child, segments, i + 1, result)
+        for pattern, child in node.globs.iteritems():
+            if fnmatch.fnmatchcase(segment, pattern):
+                self._collect(child, segments, i + 1, result)
@@ -14,17 +14,25 @@ import sys
 import fcntl
 import traceback
 import time
+import functools
 
 import gevent
+import gevent.event
 import gevent.monkey
 gevent.monkey.patch_all(thread=False)
 
-from geocamPycroraptor2.util import trackerG
+from geocamPycroraptor2.util import trackerG, watchChild, getReturnCode
 from geocamPycroraptor2.signals import SIG_VERBOSE
-from geocamPycroraptor2 import prexceptions, log
+from geocamPycroraptor2 import prexceptions, log, spawn, ratelimit, rotation, logindex, logquery
+from geocamPycroraptor2 import binlog
+from geocamPycroraptor2 import limits as limitslib
+from geocamPycroraptor2 import restartpolicy
 from geocamPycroraptor2 import status as statuslib
 
 
+# log file name template of services without a 'log' field
+DEFAULT_LOG_NAME = '${name}_${unique}.txt'
+
 try:
     MAXFD = os.sysconf("SC_OPEN_MAX")
 except:  # pylint: disable=W0702
@@ -128,12 +136,7 @@ class PopenNoErrPipe(object):
             try:
                 pid, sts = os.waitpid(self.pid, os.WNOHANG)
                 if pid == self.pid:
-                    if os.WIFSIGNALED(sts):
-                        self.returncode = -os.WTERMSIG(sts)
-                    elif os.WIFEXITED(sts):
-                        self.returncode = os.WEXITSTATUS(sts)
-                    else:
-                        raise RuntimeError("don't understand exit status %s" % sts)
+                    self.returncode = getReturnCode(sts)
             except os.error as e:
                 if e.errno == errno.ECHILD:
                     self.returncode = 0
@@ -147,6 +150,7 @@ class Service(object):
     def __init__(self, name, parent):
         self._name = name
         self._proc = None
+        self._exited = None
         self._childStdin = None
         self._tslineLogger = None
         self._logBuffer = None
@@ -154,28 +158,54 @@ class Service(object):
         self._outLogger = None
         self._errLogger = None
         self._eventLogger = None
-        self._stdinLogger = None
         self._statusDict = None
         self._status = None
         self._jobs = []
         self._parent = parent
         self._env = {'name': self._name}
+        self._topics = dict([(stream, 'service.%s.%s' % (self._name, stream))
+                             for stream in ('out', 'err', 'inp')])
         self._log = None
+        self._logWriter = None
+        self._binEncoder = None
+        self._outputLimiter = None
+        self._inCgroup = False
+        self._startTime = None
+        self._stopRequested = False
+        # automatic restarts: total, and in the current crash loop
+        self._restartCount = 0
+        self._restartAttempt = 0
+        self._restartJob = None
         self._setStatus({'status': statuslib.NOT_STARTED})
         self._restart = False
         self._streamHandler = None
-        # self._publishHandler = None
+        self._publishHandler = None
+        self._detachedConfig = None
 
     def getConfig(self):
+        if self._detachedConfig is not None:
+            return self._detachedConfig
         return self._parent.getServiceConfig(self._name)
 
+    def detachConfig(self, config):
+        """
+        Use *config* from now on instead of looking up the service in
+        the manager config. Used when the service is removed from the
+        config but still has to be stopped.
+        """
+        self._detachedConfig = config
+        self._restart = False
+        self._cancelAutoRestart()
+
     def getCommand(self):
         return self.getConfig().get('command',
                                     self._name)
 
     def getLogNameTemplate(self):
-        return self.getConfig().get('log',
-                                    '${name}_${unique}.txt')
+        return self.getConfig().get('log', DEFAULT_LOG_NAME)
+
+    def getLogPathTemplate(self):
+        return os.path.join(self._parent._logDir, self.getLogNameTemplate())
 
     def getWorkingDir(self):
         return self.getConfig().get('cwd')
@@ -189,6 +219,96 @@ class Service(object):
     def getStdin(self):
         return self.getConfig().get('stdin')
 
+    def getLaunchMethod(self):
+        return self.getConfig().get('launchMethod',
+                                    self._parent._config.get('LAUNCH_METHOD', 'spawn'))
+
+    def getLogBufferLines(self):
+        logBufferLines = int(self.getConfig().get('logBufferLines', 2048))
+        if logBufferLines < 1:
+            raise ValueError('logBufferLines should be at least 1, got %s' % logBufferLines)
+        return logBufferLines
+
+    def getLogBufferBytes(self):
+        logBufferBytes = int(self.getConfig().get('logBufferBytes', 256 * 1024))
+        if logBufferBytes < 1:
+            raise ValueError('logBufferBytes should be at least 1, got %s' % logBufferBytes)
+        return logBufferBytes
+
+    def getLogFlushMs(self):
+        return self.getConfig().get('logFlushMs', 200)
+
+    def getLogFlushBytes(self):
+        return self.getConfig().get('logFlushBytes', 64 * 1024)
+
+    def getLogFormat(self):
+        logFormat = self.getConfig().get('logFormat', 'text')
+        if logFormat not in ('text', 'binary'):
+            raise ValueError('logFormat for service %s should be "text" or "binary", got %s'
+                             % (self._name, logFormat))
+        return logFormat
+
+    def getLogSuffix(self):
+        if self.getLogFormat() == 'binary':
+            return binlog.BINARY_SUFFIX
+        return ''
+
+    def getLogIndexInterval(self):
+        return self.getConfig().get('logIndexInterval', logindex.DEFAULT_INDEX_INTERVAL)
+
+    def getMaxLineLength(self):
+        return self.getConfig().get('maxLineLength', 160)
+
+    def getOutputLimiter(self):
+        config = self.getConfig()
+        linesPerSecond = config.get('maxLinesPerSecond')
+        bytesPerSecond = config.get('maxBytesPerSecond')
+        if not (linesPerSecond or bytesPerSecond):
+            return None
+        return ratelimit.OutputLimiter(linesPerSecond,
+                                       bytesPerSecond,
+                                       burstSeconds=config.get('outputBurstSeconds', 1.0),
+                                       mode=config.get('outputLimitMode', 'drop'),
+                                       reportSuppressed=self._reportSuppressed)
+
+    def getLogRotator(self, logPath, suffix=''):
+        config = self.getConfig()
+        return rotation.LogRotator(self._name, logPath, self._env,
+                                   suffix=suffix,
+                                   rotateBytes=config.get('logRotateBytes'),
+                                   rotateSeconds=config.get('logRotateSeconds'),
+                                   compress=config.get('logCompress', True),
+                                   maxLogBytes=config.get('maxLogBytes'),
+                                   maxLogFiles=config.get('maxLogFiles'),
+                                   maxLogDirBytes=self._parent._config.get('MAX_LOG_DIR_BYTES'),
+                                   logDirTemplates=self._parent._getLogTemplates())
+
+    def getLimits(self):
+        return limitslib.parseLimits(self.getConfig().get('limits'))
+
+    def getRestartPolicy(self):
+        return restartpolicy.checkPolicy(self.getConfig().get('restart',
+                                                              restartpolicy.NEVER))
+
+    def getRestartDelay(self, attempt):
+        config = self.getConfig()
+        return restartpolicy.getRestartDelay(attempt,
+                                             config.get('restartBackoffSeconds', 1.0),
+                                             config.get('restartBackoffMaxSeconds', 60.0),
+                                             config.get('restartBurst', 3))
+
+    def getRestartResetSeconds(self):
+        return self.getConfig().get('restartResetSeconds', 60.0)
+
+    def getDrainTimeout(self):
+        return self.getConfig().get('drainTimeout', 0.5)
+
+    def getStopTimeout(self):
+        return self.getConfig().get('stopTimeout', 5)
+
+    def getKillTimeout(self):
+        return self.getConfig().get('killTimeout', 5)
+
     def openExternalStreams(self):
         """
         If needed, open streams that connect the child process console
@@ -218,9 +338,15 @@ class Service(object):
             os.dup2(fd, 1)
             os.close(fd)
 
-    def start(self):
+    def start(self, auto=False):
         if not self.isStartable():
             raise prexceptions.ServiceAlreadyActive(self._name)
+        if not auto:
+            # a manual start ends any crash loop
+            self._cancelAutoRestart()
+            self._restartAttempt = 0
+        self._stopRequested = False
+        self._startTime = time.time()
 
         cmdArgs = shlex.split(self.getCommand().encode('utf8'))
 
@@ -228,36 +354,60 @@ class Service(object):
         self._logger.setLevel(logging.DEBUG)
         self._logger.propagate = False
 
-        #self._logBuffer = log.LineBuffer()
-        # FIX: add handler for line buffer
+        if self._logBuffer is None:
+            # created once and kept across restarts, so clients can
+            # still see the output of a crashed run
+            self._logBuffer = log.LineBuffer(self.getLogBufferLines(),
+                                             self.getLogBufferBytes())
+            self._logBuffer.setLevel(logging.DEBUG)
+            self._logBuffer.setFormatter(log.UtcFormatter('%(asctime)s %(name)s %(message)s'))
+            self._logger.addHandler(self._logBuffer)
 
         logName = self.getLogNameTemplate()
+        logSuffix = self.getLogSuffix()
         self._log = None
+        self._binEncoder = None
         if logName is not None:
-            logPath = os.path.join(self._parent._logDir,
-                                   logName)
+            logPath = self.getLogPathTemplate()
             try:
-                _fname, self._log = (log.openLogFromTemplate
-                                     (self._name,
-                                      logPath,
-                                      self._env))
+                fname, self._log = (log.openLogFromTemplate
+                                    (self._name,
+                                     logPath + logSuffix,
+                                     self._env))
             except:  # pylint: disable=W0702
 #                 traceback.print_exc()
                 self._parent._logger.warning('could not open log file for service %s at path %s',
                                              self._name, logPath)
 
         if self._log is not None:
-            #sh = logging.StreamHandler(self._log)
-            fmt = log.UtcFormatter('%(asctime)s %(name)s %(message)s')
-            self._streamHandler = log.AutoFlushStreamHandler(self._log)
+            segmentHeader = None
+            if logSuffix == binlog.BINARY_SUFFIX:
+                self._binEncoder = binlog.RecordEncoder('service.%s' % self._name)
+                segmentHeader = self._binEncoder.getHeader()
+            rotator = self.getLogRotator(logPath, logSuffix)
+            self._logWriter = log.LogWriter(self._log,
+                                            self.getLogFlushMs() / 1000.0,
+                                            self.getLogFlushBytes(),
+                                            path=fname,
+                                            rotator=rotator,
+                                            indexInterval=self.getLogIndexInterval(),
+                                            segmentHeader=segmentHeader)
+            # logs from earlier runs count against retention limits too
+            rotator.enforceRetention()
+            if self._binEncoder is not None:
+                self._streamHandler = binlog.BinaryLogWriterHandler(self._logWriter,
+                                                                    self._binEncoder)
+            else:
+                self._streamHandler = log.LogWriterHandler(self._logWriter)
+                fmt = log.UtcFormatter('%(asctime)s %(name)s %(message)s')
+                self._streamHandler.setFormatter(fmt)
             self._streamHandler.setLevel(logging.DEBUG)
-            self._streamHandler.setFormatter(fmt)
             self._logger.addHandler(self._streamHandler)
 
-            #self._publishHandler = log.PublishHandler(self._parent._qrouter)
-            #self._publishHandler.setLevel(logging.DEBUG)
-            #self._publishHandler.setFormatter(fmt)
-            #self._logger.addHandler(self._publishHandler)
+        self._publishHandler = log.PublishHandler(self._parent._qrouter)
+        self._publishHandler.setLevel(logging.DEBUG)
+        self._publishHandler.setFormatter(log.UtcFormatter('%(asctime)s %(name)s %(message)s'))
+        self._logger.addHandler(self._publishHandler)
 
         stdinPath = self.getStdin()
         if stdinPath is None:
@@ -291,33 +441,79 @@ class Service(object):
                                 for arg in cmdArgs])
         self._eventLogger.info('command: %s', escapedArgs)
 
-        if self.getStdin() or self.getStdout():
+        startupError = None
+        rlimits = []
+        cgroupProcs = None
+        try:
+            limits = self.getLimits()
+        except ValueError, err:
+            startupError = 'bad limits config: %s' % err
+            limits = {}
+        if limits:
+            cgroups = self._parent._getCgroupManager()
+            if cgroups is not None:
+                try:
+                    cgroupProcs = cgroups.prepare(self._name, limits)
+                except EnvironmentError, err:
+                    self._eventLogger.warning('could not set up cgroup: %s', err)
+            controllers = cgroups.getControllers() if cgroupProcs else []
+            rlimits = limitslib.getRlimits(limits, controllers)
+            self._eventLogger.info('limits: %s%s',
+                                   ' '.join(['%s=%s' % item for item in sorted(limits.items())]),
+                                   ' (in cgroup)' if cgroupProcs else '')
+        self._inCgroup = cgroupProcs is not None
+
+        popenArgs = dict(stdin=popenStdin,
+                         stdout=popenStdout,
+                         stderr=childStderrWriteFd,
+                         env=childEnv,
+                         cwd=self.getWorkingDir())
+        zygote = self._parent._zygote
+        if (self.getLaunchMethod() == 'zygote'
+                and zygote is not None and zygote.isAlive()):
+            popenClass = spawn.PopenZygote
+            popenArgs.update(zygote=zygote,
+                             stdinPath=self.getStdin(),
+                             stdoutPath=self.getStdout(),
+                             rlimits=rlimits,
+                             cgroupProcs=cgroupProcs)
+        elif self.getStdin() or self.getStdout():
+            # opening named pipes can block, so it must happen in the
+            # child after the fork
             popenClass = PopenNoErrPipe
+            popenArgs.update(close_fds=True,
+                             preexec_fn=self.openExternalStreams)
+        elif (self.getLaunchMethod() == 'spawn'
+              and not limits
+              and spawn.canSpawn(popenArgs['cwd'])):
+            # limits must be applied in the child, which posix_spawn
+            # can't do
+            popenClass = spawn.PopenPosixSpawn
         else:
             popenClass = subprocess.Popen
+            popenArgs.update(close_fds=True)
+        if limits and popenClass is not spawn.PopenZygote:
+            popenArgs['preexec_fn'] = limitslib.getPreexecFn(rlimits, cgroupProcs,
+                                                             popenArgs.get('preexec_fn'))
 
-        startupError = None
-        try:
-            self._proc = popenClass(cmdArgs,
-                                    stdin=popenStdin,
-                                    stdout=popenStdout,
-                                    stderr=childStderrWriteFd,
-                                    env=childEnv,
-                                    close_fds=True,
-                                    cwd=self.getWorkingDir(),
-                                    preexec_fn=self.openExternalStreams)
-        except OSError, oe:
-            if oe.errno == errno.ENOENT:
-                startupError = ('is executable "%s" in PATH? Popen call returned no such file or directory'
-                                % cmdArgs[0])
-            else:
-                startupError = oe
-        except Exception, exc:
-            startupError = exc
+        if startupError is None:
+            try:
+                self._proc = popenClass(cmdArgs, **popenArgs)
+            except OSError, oe:
+                if oe.errno == errno.ENOENT:
+                    startupError = ('is executable "%s" in PATH? Popen call returned no such file or directory'
+                                    % cmdArgs[0])
+                else:
+                    startupError = oe
+            except Exception, exc:
+                startupError = exc
         if not stdoutPath:
             trackerG.close(childStdoutWriteFd)
         trackerG.close(childStderrWriteFd)
         if startupError is not None:
+            if not stdoutPath:
+                trackerG.close(childStdoutReadFd)
+            trackerG.close(childStderrReadFd)
             self._eventLogger.warning('startup error: %s', startupError)
             self._parent._logger.debug('failed to start service %s', self._name)
             self._setStatus(dict(status=statuslib.FAILED,
@@ -327,33 +523,49 @@ class Service(object):
             self._postExitCleanup()
         else:
             if not stdinPath:
-                self._stdinLogger = self._logger.getChild('inp')
-                self._stdinLogger.setLevel(logging.DEBUG)
                 self._childStdin = self._proc.stdin
 
+            self._outputLimiter = self.getOutputLimiter()
             if not stdoutPath:
                 self._outLogger = (log.StreamLogger
                                    (childStdoutReadFd,
-                                    self._logger.getChild('out'),
-                                    label='%s.out' % self._name))
+                                    functools.partial(self._logConsoleLines, 'out'),
+                                    maxLineLength=self.getMaxLineLength(),
+                                    label='%s.out' % self._name,
+                                    limiter=self._outputLimiter))
 
             self._errLogger = (log.StreamLogger
                                (childStderrReadFd,
-                                self._logger.getChild('err'),
-                                label='%s.err' % self._name))
+                                functools.partial(self._logConsoleLines, 'err'),
+                                maxLineLength=self.getMaxLineLength(),
+                                label='%s.err' % self._name,
+                                limiter=self._outputLimiter))
             self._setStatus(dict(status=statuslib.RUNNING,
                                  procStatus=statuslib.RUNNING,
                                  pid=self._proc.pid))
+            self._exited = gevent.event.Event()
+            if hasattr(self._proc, 'watchExit'):
+                # not our child, exit is reported by the launcher
+                self._proc.watchExit(self._handleExit, self._proc, self._exited)
+            else:
+                watchChild(self._proc.pid, self._handleExit, self._proc, self._exited)
 
     def stop(self):
         if not self.isActive():
+            if self._restartJob is not None:
+                # waiting to restart after a crash; stop means don't
+                return self._cancelAutoRestart()
             raise prexceptions.ServiceNotActive(self._name)
 
+        self._stopRequested = True
+
         statusDict = self._statusDict.copy()
         statusDict['status'] = statuslib.STOPPING
         self._setStatus(statusDict)
 
-        self._jobs.append(gevent.spawn(self._stopInternal))
+        job = gevent.spawn(self._stopInternal)
+        self._jobs.append(job)
+        return job
 
     def restart(self):
         if self.isActive():
@@ -363,7 +575,75 @@ class Service(object):
             self.start()
 
     def getStatus(self):
-        return self._statusDict
+        extra = {}
+        if self._logWriter is not None:
+            extra['logStats'] = self._logWriter.getStats()
+        if self._outputLimiter is not None:
+            extra['outputLimit'] = self._outputLimiter.getStats()
+        sampler = self._parent._resourceSampler
+        if sampler is not None and self.getPid() is not None:
+            resources = sampler.getLatest(self._name)
+            if resources is not None:
+                extra['resources'] = resources
+        if self._inCgroup:
+            cgroupStats = self._parent._getCgroupManager().getStats(self._name)
+            if cgroupStats is not None:
+                extra['cgroup'] = cgroupStats
+        if not extra:
+            return self._statusDict
+        result = self._statusDict.copy()
+        result.update(extra)
+        return result
+
+    def getPid(self):
+        """
+        Return the pid of the running process, or None.
+        """
+        if self._proc is None or self._proc.returncode is not None:
+            return None
+        return self._proc.pid
+
+    def flushLog(self):
+        if self._logWriter is not None:
+            self._logWriter.flush()
+
+    def getLog(self, minTime=None, maxLines=None):
+        if self._logBuffer is None:
+            return []
+        return self._logBuffer.getLines(minTime, maxLines)
+
+    def getLogSegmentPath(self):
+        """
+        Return the path of the log segment being written, or of the
+        latest segment if the service is not running.
+        """
+        if self._logWriter is not None:
+            return self._logWriter.getPath()
+        logName = self.getLogNameTemplate()
+        if logName is None:
+            return None
+        latestLink = log._expandUniq(self.getLogPathTemplate() + self.getLogSuffix(),
+                                     'latest', self._env)
+        if not os.path.exists(latestLink):
+            return None
+        return os.path.realpath(latestLink)
+
+    def readLog(self, startTime=None, endTime=None, maxBytes=None):
+        self.flushLog()
+        path = self.getLogSegmentPath()
+        if path is None:
+            return dict(path=None, lines=[], truncated=False)
+        lines, truncated = logquery.readRange(path, startTime, endTime, maxBytes)
+        return dict(path=path, lines=lines, truncated=truncated)
+
+    def queryLog(self, startTime=None, endTime=None, topics=None, pattern=None,
+                 maxLines=None):
+        logName = self.getLogNameTemplate()
+        if logName is None:
+            return iter([])
+        self.flushLog()
+        return logquery.queryLog(self.getLogPathTemplate(), self._env,
+                                 startTime, endTime, topics, pattern, maxLines)
 
     def isActive(self):
         return statuslib.isActive(self._status)
@@ -372,32 +652,80 @@ class Service(object):
         return statuslib.isStartable(self._status)
 
     def _stopInternal(self):
-        if self._proc:
-            self._eventLogger.warning('received stop command, sending SIGTERM signal')
-            self._proc.terminate()
-        time.sleep(5)
-        if self._proc:
-            self._eventLogger.warning('service did not stop after first attempt, sending SIGKILL signal')
-            self._proc.kill()
-            time.sleep(5)
-        if self._proc:
-            self._eventLogger.warning('service did not stop after second attempt, sending SIGKILL signal')
-            self._proc.kill()
-            time.sleep(5)
-            self._eventLogger.error('SERVICE DID NOT STOP YOU MUST KILL IT YOURSELF')
+        """
+        Send SIGTERM, then SIGKILL, returning as soon as the process
+        exits. The grace period after each signal is set by the
+        stopTimeout and killTimeout service config fields.
+        """
+        proc = self._proc
+        exited = self._exited
+        eventLogger = self._eventLogger
+        if proc is None:
+            return
+        attempts = ((signal.SIGTERM, self.getStopTimeout(),
+                     'received stop command, sending SIGTERM signal'),
+                    (signal.SIGKILL, self.getKillTimeout(),
+                     'service did not stop after first attempt, sending SIGKILL signal'))
+        for sigNum, timeout, msg in attempts:
+            if exited.is_set():
+                return
+            eventLogger.warning(msg)
+            try:
+                proc.send_signal(sigNum)
+            except OSError, oe:
+                if oe.errno != errno.ESRCH:
+                    raise
+                # already gone, exit notification is on its way
+            if exited.wait(timeout):
+                return
+        eventLogger.error('SERVICE DID NOT STOP YOU MUST KILL IT YOURSELF')
+
+    def _logConsoleLines(self, stream, created, texts):
+        """
+        Fast path for console lines. Formats a batch of lines the way
+        the service logger would and hands them straight to the log
+        file, line buffer and subscribers, skipping LogRecord creation.
+        """
+        topic = self._topics[stream]
+        prefix = '%s %s ' % (log.formatUtcTime(created), topic)
+        lines = [prefix + text for text in texts]
+        if self._logWriter is not None:
+            if self._binEncoder is not None:
+                data = self._binEncoder.encodeConsoleLines(created, stream, texts)
+            else:
+                data = '\n'.join(lines) + '\n'
+            self._logWriter.write(data, len(lines), created)
+        for line in lines:
+            self._logBuffer.append(created, line)
+        router = self._parent._qrouter
+        if router.hasSubscribers(topic):
+            for line in lines:
+                router.publish(topic, line)
+
+    def _reportSuppressed(self, numLines):
+        if self._eventLogger:
+            self._eventLogger.warning('output rate limit exceeded, suppressed %s lines',
+                                      numLines)
 
     def _setStatus(self, statusDict):
+        if self._restartCount and 'restartCount' not in statusDict:
+            statusDict = dict(statusDict, restartCount=self._restartCount)
         self._statusDict = statusDict
         self._status = statusDict['status']
+        self._parent._statusStore.update(self._name, statusDict)
+
+    def _handleExit(self, rstatus, proc, exited):
+        # called from the gevent hub when the child exits
+        if proc.returncode is None:
+            proc.returncode = getReturnCode(rstatus)
+        exited.set()
+        if proc is self._proc:
+            gevent.spawn(self._cleanup)
 
     def _cleanup(self):
         if self._proc and self._proc.poll() is not None:
             # process exited
-
-            # bit of a hack... leave some time to collect console
-            # output. needs to be longer than the refresh period in
-            # geocamUtil.geventUtil.util.copyFileToQueue()
-            gevent.sleep(0.15)
+            self._drainOutput()
 
             if self._proc.returncode < 0:
                 sigNum = -self._proc.returncode
@@ -423,16 +751,34 @@ class Service(object):
             self._setStatus(newStatus)
             self._eventLogger.warning('stopped')
             self._eventLogger.warning('status: %s', newStatus)
-            if newStatus['status'] != statuslib.SEGFAULT:
+            if newStatus['status'] != statuslib.SEGFAULT or self._wantsAutoRestart():
                 self._postExitCleanup()
             else:
-                self._forceAbort()  
-                self._postExitCleanup() 
-                
+                self._forceAbort()
+                self._postExitCleanup()
+            self._parent._checkForQuitComplete()
+
+    def _drainOutput(self):
+        """
+        Wait for the console streams to reach end of file so the last
+        output of the process is logged before its exit status. The
+        wait is bounded because a surviving grandchild can hold the
+        pty open indefinitely.
+        """
+        deadline = time.time() + self.getDrainTimeout()
+        for streamLogger in (self._outLogger, self._errLogger):
+            if streamLogger:
+                timeout = max(0, deadline - time.time())
+                if not streamLogger.waitForEof(timeout):
+                    self._parent._logger.debug('%s: timed out waiting for end of console output',
+                                               self._name)
+                    break
+        if self._outputLimiter:
+            self._outputLimiter.reportPending()
 
     def _forceAbort(self):
         os.abort()
-        
+
     def _postExitCleanup(self):
         self._proc = None
         for job in self._jobs:
@@ -449,27 +795,82 @@ class Service(object):
             self._errLogger = None
         if self._eventLogger:
             self._eventLogger = None
-        if self._stdinLogger:
-            self._stdinLogger = None
         if self._streamHandler:
             self._logger.removeHandler(self._streamHandler)
             self._streamHandler = None
-        #if self._publishHandler:
-        #    self._logger.removeHandler(self._publishHandler)
-        #    self._publishHandler = None
-        if self._log:
-            self._log.close()
+        if self._publishHandler:
+            self._logger.removeHandler(self._publishHandler)
+            self._publishHandler = None
+        if self._logWriter:
+            self._logWriter.close()
+            self._logWriter = None
             self._log = None
         # note: keep self._logBuffer around in case a client requests old log data.
-        #  it will be reinitialized the next time the task is started.
         if self._restart:
             self._restart = False
             self.start()
+        else:
+            self._scheduleAutoRestart()
+
+    def _wantsAutoRestart(self):
+        """
+        Return True if the restart policy calls for restarting the
+        service after it exited with the current status.
+        """
+        if self._stopRequested or self._parent._quitting:
+            return False
+        try:
+            policy = self.getRestartPolicy()
+        except ValueError, err:
+            self._parent._logger.warning('service %s: %s', self._name, err)
+            return False
+        return restartpolicy.shouldRestart(policy, self._status)
+
+    def _scheduleAutoRestart(self):
+        if not self._wantsAutoRestart():
+            return
+
+        now = time.time()
+        if self._startTime is not None and now - self._startTime >= self.getRestartResetSeconds():
+            # it ran long enough; this is not part of a crash loop
+            self._restartAttempt = 0
+        self._restartAttempt += 1
+        delay = self.getRestartDelay(self._restartAttempt)
+        self._parent._logger.info('service %s exited with status %s, restarting in %ss (attempt %s)',
+                                  self._name, self._status, delay, self._restartAttempt)
+        statusDict = self._statusDict.copy()
+        statusDict.update(nextRestartTime=now + delay,
+                          restartAttempt=self._restartAttempt)
+        self._setStatus(statusDict)
+        self._restartJob = gevent.spawn_later(delay, self._autoRestart)
+
+    def _autoRestart(self):
+        self._restartJob = None
+        if self._parent._quitting or not self.isStartable():
+            return
+        self._restartCount += 1
+        self.start(auto=True)
+
+    def _cancelAutoRestart(self):
+        """
+        Cancel a pending automatic restart. Returns the cancelled job, or
+        None.
+        """
+        job = self._restartJob
+        if job is None:
+            return None
+        self._restartJob = None
+        job.kill()
+        statusDict = self._statusDict.copy()
+        statusDict.pop('nextRestartTime', None)
+        statusDict.pop('restartAttempt', None)
+        self._setStatus(statusDict)
+        return job
 
     def stdin(self, text):
         if not self.isActive():
             raise prexceptions.ServiceNotActive(self._name)
 
-        self._stdinLogger.info(log.escapeEndOfLine(text))
+        self._logConsoleLines('inp', time.time(), [log.escapeEndOfLine(text)])
         self._childStdin.write(text)
         self._childStdin.flush()
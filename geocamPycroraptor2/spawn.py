@@ -0,0 +1,380 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Fast process launch paths that avoid copying the address space of the
+(possibly large) pyraptord process: the C library posix_spawnp(), which
+can use vfork() or clone(CLONE_VFORK), and a small launcher helper
+process (see zygote.py).
+"""
+
+import os
+import sys
+import errno
+import signal
+import fcntl
+import socket
+import ctypes
+import ctypes.util
+import subprocess
+import _multiprocessing
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.socket
+
+from geocamPycroraptor2.util import getReturnCode
+from geocamPycroraptor2 import zygote
+
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSIGMASK = 0x08
+
+# opaque libc structs; these are larger than any known implementation
+SPAWN_STRUCT_SIZE = 1024
+SIGSET_SIZE = 256
+
+_libc = None
+
+
+def _getLibc():
+    global _libc  # pylint: disable=W0603
+    if _libc is None:
+        libcPath = ctypes.util.find_library('c')
+        try:
+            lib = ctypes.CDLL(libcPath, use_errno=True)
+            lib.posix_spawnp  # pylint: disable=W0104
+        except (OSError, AttributeError):
+            lib = False
+        _libc = lib
+    return _libc
+
+
+def _hasLibcFunction(name):
+    lib = _getLibc()
+    return bool(lib) and hasattr(lib, name)
+
+
+def isAvailable():
+    return bool(_getLibc())
+
+
+def canSpawn(cwd=None):
+    """
+    Return True if PopenPosixSpawn can launch a child with working
+    directory *cwd* on this platform.
+    """
+    if not isAvailable():
+        return False
+    if cwd and not _hasLibcFunction('posix_spawn_file_actions_addchdir_np'):
+        return False
+    return True
+
+
+def _setCloexecOnInheritedFds():
+    # fallback for libcs without posix_spawn_file_actions_addclosefrom_np
+    for fdDir in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(fdDir):
+            break
+    else:
+        return
+    for name in os.listdir(fdDir):
+        fd = int(name)
+        if fd < 3:
+            continue
+        try:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            if not flags & fcntl.FD_CLOEXEC:
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        except (IOError, OSError):
+            pass  # fd used by listdir itself, already closed
+
+
+def _check(result, what):
+    if result != 0:
+        raise OSError(result, '%s: %s' % (what, os.strerror(result)))
+
+
+def _cStringArray(strings):
+    # NULL-terminated char *[]
+    return (ctypes.c_char_p * (len(strings) + 1))(*strings)
+
+
+class PopenPosixSpawn(object):
+    """
+    This is a re-implementation of a subset of subprocess.Popen using
+    posix_spawnp(). Inherited file descriptors other than stdin, stdout,
+    and stderr are closed in the child, the signal mask is cleared, and
+    SIGPIPE is reset to its default disposition (the Python runtime
+    ignores it).
+
+    It does not support preexec_fn; callers that need to run code in
+    the child before exec() must use a fork-based launcher.
+    """
+
+    def __init__(self, args,
+                 stdin=None,
+                 stdout=None,
+                 stderr=None,
+                 env=None,
+                 cwd=None):
+        self.returncode = None
+        self.pid = None
+        self.stdin = None
+
+        lib = _getLibc()
+        if not lib:
+            raise OSError(errno.ENOSYS, 'posix_spawnp() is not available')
+
+        stdinWrite = None
+        if stdin is subprocess.PIPE:
+            stdin, stdinWrite = os.pipe()
+            fcntl.fcntl(stdinWrite, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            closeStdin = True
+        else:
+            closeStdin = False
+
+        fileActions = ctypes.create_string_buffer(SPAWN_STRUCT_SIZE)
+        attr = ctypes.create_string_buffer(SPAWN_STRUCT_SIZE)
+        emptyMask = ctypes.create_string_buffer(SIGSET_SIZE)
+        defaultSigs = ctypes.create_string_buffer(SIGSET_SIZE)
+        _check(lib.posix_spawn_file_actions_init(fileActions),
+               'posix_spawn_file_actions_init')
+        _check(lib.posix_spawnattr_init(attr), 'posix_spawnattr_init')
+        try:
+            for fd, childFd in ((stdin, 0), (stdout, 1), (stderr, 2)):
+                if fd is not None:
+                    _check(lib.posix_spawn_file_actions_adddup2(fileActions, fd, childFd),
+                           'posix_spawn_file_actions_adddup2')
+            if _hasLibcFunction('posix_spawn_file_actions_addclosefrom_np'):
+                _check(lib.posix_spawn_file_actions_addclosefrom_np(fileActions, 3),
+                       'posix_spawn_file_actions_addclosefrom_np')
+            else:
+                _setCloexecOnInheritedFds()
+            if cwd:
+                _check(lib.posix_spawn_file_actions_addchdir_np(fileActions, cwd),
+                       'posix_spawn_file_actions_addchdir_np')
+
+            lib.sigemptyset(emptyMask)
+            lib.sigemptyset(defaultSigs)
+            lib.sigaddset(defaultSigs, signal.SIGPIPE)
+            _check(lib.posix_spawnattr_setsigmask(attr, emptyMask),
+                   'posix_spawnattr_setsigmask')
+            _check(lib.posix_spawnattr_setsigdefault(attr, defaultSigs),
+                   'posix_spawnattr_setsigdefault')
+            _check(lib.posix_spawnattr_setflags(attr, ctypes.c_short(POSIX_SPAWN_SETSIGMASK
+                                                                     | POSIX_SPAWN_SETSIGDEF)),
+                   'posix_spawnattr_setflags')
+
+            if env is None:
+                env = os.environ
+            argv = _cStringArray([str(arg) for arg in args])
+            envp = _cStringArray(['%s=%s' % (k, v) for k, v in env.iteritems()])
+            pid = ctypes.c_int()
+            result = lib.posix_spawnp(ctypes.byref(pid), str(args[0]),
+                                      fileActions, attr, argv, envp)
+            if result != 0:
+                raise OSError(result, os.strerror(result))
+        except:  # pylint: disable=W0702
+            if stdinWrite is not None:
+                os.close(stdinWrite)
+            raise
+        finally:
+            lib.posix_spawn_file_actions_destroy(fileActions)
+            lib.posix_spawnattr_destroy(attr)
+            if closeStdin:
+                os.close(stdin)
+
+        self.pid = pid.value
+        if stdinWrite is not None:
+            self.stdin = os.fdopen(stdinWrite, 'wb', 0)
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, sts = os.waitpid(self.pid, os.WNOHANG)
+                if pid == self.pid:
+                    self.returncode = getReturnCode(sts)
+            except os.error as e:
+                if e.errno == errno.ECHILD:
+                    self.returncode = 0
+        return self.returncode
+
+    def send_signal(self, sig):
+        os.kill(self.pid, sig)
+
+
+class Zygote(object):
+    """
+    Client for the launcher helper process in zygote.py. The helper is
+    a freshly exec'd Python process, so its fork() cost stays constant
+    no matter how large pyraptord grows. Processes it launches are its
+    children, not ours, so their exit status is reported back over the
+    socket rather than through SIGCHLD.
+    """
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._nextId = 0
+        self._replies = {}
+        self._exitCallbacks = {}
+        self._exitStatus = {}
+        self._alive = True
+        self._sendLock = gevent.lock.Semaphore()
+        self._sock, childSock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        helperPath = os.path.join(os.path.dirname(os.path.abspath(zygote.__file__)),
+                                  'zygote.py')
+        self._proc = subprocess.Popen([sys.executable, helperPath],
+                                      stdin=childSock.fileno(),
+                                      close_fds=True)
+        childSock.close()
+        self._job = gevent.spawn(self._readLoop)
+        self._logger.info('started launcher zygote, pid %s', self._proc.pid)
+
+    def isAlive(self):
+        return self._alive
+
+    def _sendFd(self, fd):
+        while 1:
+            try:
+                _multiprocessing.sendfd(self._sock.fileno(), fd)
+                return
+            except OSError, oe:
+                if oe.errno != errno.EAGAIN:
+                    raise
+                gevent.socket.wait_write(self._sock.fileno())
+
+    def _readLoop(self):
+        try:
+            while 1:
+                msg = zygote.recvMessage(self._sock)
+                if msg is None:
+                    break
+                if msg['op'] in ('spawned', 'error'):
+                    self._replies.pop(msg['id']).set(msg)
+                elif msg['op'] == 'exit':
+                    pid = msg['pid']
+                    if pid in self._exitCallbacks:
+                        callback, args = self._exitCallbacks.pop(pid)
+                        callback(msg['status'], *args)
+                    else:
+                        self._exitStatus[pid] = msg['status']
+        finally:
+            self._alive = False
+            self._logger.error('launcher zygote exited; exit status of %s services it launched will not be reported',
+                               len(self._exitCallbacks))
+            for reply in self._replies.itervalues():
+                reply.set(dict(op='error', errno=errno.EPIPE,
+                               message='launcher zygote exited'))
+            self._replies = {}
+
+    def spawn(self, args, env, cwd=None, fds=None, stdinPath=None, stdoutPath=None,
+              rlimits=None, cgroupProcs=None):
+        """
+        Launch *args* in the helper. *fds* maps child fd numbers to our
+        fds, which are passed to the helper. *rlimits* and *cgroupProcs*
+        are applied in the child as in limits.enterLimits(). Returns the
+        child pid or raises OSError.
+        """
+        if not self._alive:
+            raise OSError(errno.EPIPE, 'launcher zygote is not running')
+        if fds is None:
+            fds = {}
+        requestId = self._nextId
+        self._nextId += 1
+        reply = gevent.event.AsyncResult()
+        self._replies[requestId] = reply
+        childFds = sorted(fds.keys())
+        msg = dict(op='spawn',
+                   id=requestId,
+                   args=args,
+                   env=env,
+                   cwd=cwd,
+                   fds=childFds,
+                   stdinPath=stdinPath,
+                   stdoutPath=stdoutPath,
+                   rlimits=rlimits,
+                   cgroupProcs=cgroupProcs)
+        with self._sendLock:
+            self._sock.sendall(zygote.encodeMessage(msg))
+            for childFd in childFds:
+                self._sendFd(fds[childFd])
+        result = reply.get()
+        if result['op'] == 'error':
+            raise OSError(result['errno'], result['message'])
+        return result['pid']
+
+    def watchExit(self, pid, callback, *args):
+        """
+        Call callback(rstatus, *args) when child *pid* exits.
+        """
+        if pid in self._exitStatus:
+            callback(self._exitStatus.pop(pid), *args)
+        else:
+            self._exitCallbacks[pid] = (callback, args)
+
+
+class PopenZygote(object):
+    """
+    A subset of subprocess.Popen that launches the process through a
+    Zygote. Named pipes for stdin and stdout are opened by the helper
+    in the child, as in PopenNoErrPipe, and resource limits are applied
+    there too.
+    """
+
+    def __init__(self, args,
+                 stdin=None,
+                 stdout=None,
+                 stderr=None,
+                 env=None,
+                 cwd=None,
+                 zygote=None,
+                 stdinPath=None,
+                 stdoutPath=None,
+                 rlimits=None,
+                 cgroupProcs=None):
+        self.returncode = None
+        self.pid = None
+        self.stdin = None
+        self._zygote = zygote
+
+        stdinWrite = None
+        if stdin is subprocess.PIPE:
+            stdin, stdinWrite = os.pipe()
+            fcntl.fcntl(stdinWrite, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            closeStdin = True
+        else:
+            closeStdin = False
+
+        fds = {}
+        for fd, childFd in ((stdin, 0), (stdout, 1), (stderr, 2)):
+            if fd is not None:
+                fds[childFd] = fd
+        if env is None:
+            env = dict(os.environ)
+        try:
+            self.pid = zygote.spawn(list(args), env, cwd, fds,
+                                    stdinPath, stdoutPath,
+                                    rlimits, cgroupProcs)
+        except:  # pylint: disable=W0702
+            if stdinWrite is not None:
+                os.close(stdinWrite)
+            raise
+        finally:
+            if closeStdin:
+                os.close(stdin)
+
+        if stdinWrite is not None:
+            self.stdin = os.fdopen(stdinWrite, 'wb', 0)
+
+    def watchExit(self, callback, *args):
+        self._zygote.watchExit(self.pid, callback, *args)
+
+    def poll(self):
+        return self.returncode
+
+    def send_signal(self, sig):
+        os.kill(self.pid, sig)
@@ -24,7 +24,8 @@ ERROR_EXIT = 'errorExit'
 STARTABLE_STATUS = (NOT_STARTED,
                     SUCCESS,
                     ABORTED,
-                    FAILED)
+                    FAILED,
+                    SEGFAULT)
 
 ACTIVE_STATUS = (STARTING,
                  RUNNING,
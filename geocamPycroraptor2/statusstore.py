@@ -0,0 +1,103 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+import uuid
+
+import gevent.event
+
+
+class StatusStore(object):
+    """
+    Records service status changes with version numbers. Every change
+    takes the next value of a single counter, so each service's version
+    only increases and a client can ask for everything that changed
+    since the last version it saw. Also keeps a snapshot of all
+    statuses that is only rebuilt when something changes.
+
+    Versions start over when pyraptord restarts, so each store also has
+    a random epoch id. A client holding a version from a different
+    epoch must start over from a full snapshot.
+    """
+
+    def __init__(self):
+        self._version = 0
+        self._epoch = uuid.uuid4().hex
+        # service name -> (version, status dict or None if removed)
+        self._entries = {}
+        self._changed = gevent.event.Event()
+        self._snapshot = None
+        self._snapshotVersion = None
+
+    def getVersion(self):
+        return self._version
+
+    def getEpoch(self):
+        return self._epoch
+
+    def isCurrent(self, version, epoch=None):
+        """
+        Return False if *version* (from epoch *epoch*, if known) can't
+        have come from this store.
+        """
+        if epoch is not None and epoch != self._epoch:
+            return False
+        return version <= self._version
+
+    def update(self, name, statusDict):
+        self._version += 1
+        self._entries[name] = (self._version, statusDict)
+        self._notify()
+
+    def remove(self, name):
+        """
+        Record that service *name* no longer exists. It is reported with
+        status None.
+        """
+        self._version += 1
+        self._entries[name] = (self._version, None)
+        self._notify()
+
+    def _notify(self):
+        changed = self._changed
+        self._changed = gevent.event.Event()
+        changed.set()
+
+    def getSnapshot(self):
+        """
+        Return {name: status} for all current services. The dict is
+        rebuilt only after a change and is shared between callers, who
+        must not modify it.
+        """
+        if self._snapshotVersion != self._version:
+            self._snapshot = dict([(name, status)
+                                   for name, (_version, status) in self._entries.iteritems()
+                                   if status is not None])
+            self._snapshotVersion = self._version
+        return self._snapshot
+
+    def get(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def getChangesSince(self, version):
+        """
+        Return {name: status} for services changed after *version*.
+        """
+        return dict([(name, status)
+                     for name, (entryVersion, status) in self._entries.iteritems()
+                     if entryVersion > version])
+
+    def waitForChange(self, version, timeout=None):
+        """
+        Block until there are changes after *version* or *timeout*
+        seconds pass. Returns True if there are changes.
+        """
+        if self._version > version:
+            return True
+        self._changed.wait(timeout)
+        return self._version > version
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Measure how many short-lived processes per second each pyraptord launch
+path can start. Use --heapMb to grow the benchmark process first, which
+shows how fork-based launch cost scales with the size of the parent.
+
+Example: ./launchBenchmark.py -n 500 --heapMb 500
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+from geocamPycroraptor2.service import PopenNoErrPipe
+from geocamPycroraptor2 import spawn
+
+
+def launchPopen(args, devNull):
+    return subprocess.Popen(args, stdout=devNull, stderr=devNull, close_fds=True)
+
+
+def launchNoErrPipe(args, devNull):
+    return PopenNoErrPipe(args, stdout=devNull, stderr=devNull, close_fds=True)
+
+
+def launchPosixSpawn(args, devNull):
+    return spawn.PopenPosixSpawn(args, stdout=devNull, stderr=devNull)
+
+
+def benchmark(name, launch, n, args):
+    devNull = os.open('/dev/null', os.O_WRONLY)
+    startTime = time.time()
+    for _ in xrange(n):
+        proc = launch(args, devNull)
+        os.waitpid(proc.pid, 0)
+    elapsed = time.time() - startTime
+    os.close(devNull)
+    print '%-20s %8.1f launches/sec' % (name, n / elapsed)
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: %prog')
+    parser.add_option('-n', '--num',
+                      type='int', default=200,
+                      help='Number of launches per method [%default]')
+    parser.add_option('--heapMb',
+                      type='int', default=0,
+                      help='Grow the heap by this many MB before measuring [%default]')
+    parser.add_option('--command',
+                      default='/bin/true',
+                      help='Command to launch [%default]')
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no args')
+
+    ballast = []
+    for _ in xrange(opts.heapMb):
+        # touch every page so the memory is really mapped
+        ballast.append(bytearray('x' * (1024 * 1024)))
+    print 'heap ballast: %s MB' % opts.heapMb
+
+    cmdArgs = opts.command.split()
+    methods = [('subprocess.Popen', launchPopen),
+               ('PopenNoErrPipe', launchNoErrPipe)]
+    if spawn.isAvailable():
+        methods.append(('PopenPosixSpawn', launchPosixSpawn))
+    else:
+        print >> sys.stderr, 'posix_spawnp() not available, skipping PopenPosixSpawn'
+    for name, launch in methods:
+        benchmark(name, launch, opts.num, cmdArgs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Compare console lines/sec through the logging module (the old
+StreamLogger path) against the log.formatLine() fast path. Both write
+the same bytes to an in-memory file.
+"""
+
+import time
+import logging
+from cStringIO import StringIO
+
+from geocamPycroraptor2 import log
+
+
+def loggingPath(n, text):
+    out = StringIO()
+    logger = logging.getLogger('service.bench')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    handler = logging.StreamHandler(out)
+    handler.setFormatter(log.UtcFormatter('%(asctime)s %(name)s %(message)s'))
+    logger.addHandler(handler)
+    outLogger = logger.getChild('out')
+    for _ in xrange(n):
+        outLogger.info(log.escapeEndOfLine(text))
+    logger.removeHandler(handler)
+    return out.getvalue()
+
+
+def fastPath(n, text):
+    out = StringIO()
+    for _ in xrange(n):
+        line = log.formatLine(time.time(), 'service.bench.out',
+                              log.escapeEndOfLine(text))
+        out.write(line + '\n')
+    return out.getvalue()
+
+
+def benchmark(name, func, n, text):
+    startTime = time.time()
+    output = func(n, text)
+    elapsed = time.time() - startTime
+    print '%-10s %10.0f lines/sec' % (name, n / elapsed)
+    return output
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: %prog')
+    parser.add_option('-n', '--num',
+                      type='int', default=200000,
+                      help='Number of lines per method [%default]')
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no args')
+
+    text = 'the quick brown fox jumps over the lazy dog\n'
+    slow = benchmark('logging', loggingPath, opts.num, text)
+    fast = benchmark('fast path', fastPath, opts.num, text)
+
+    # the formats must match apart from timestamps
+    slowLine = slow.splitlines()[0].split(' ', 1)[1]
+    fastLine = fast.splitlines()[0].split(' ', 1)[1]
+    assert slowLine == fastLine, (slowLine, fastLine)
+
+    # console output ends a line at a bare '\r' too, as LineParser did
+    lines, partial = log.splitLines('a\rb\r\nc\n', 160)
+    assert lines == ['r a', 'n b', 'n c'], lines
+    assert partial == '', partial
+    # a trailing '\r' waits to see if '\n' follows
+    assert log.splitLines('a\r', 160) == ([], 'a\r')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,5 +8,7 @@ from django.conf.urls import url
 
 from geocamPycroraptor2 import views
 
-urlpatterns = [url(r'^$', views.dashboard, {}, name='geocamPycroraptor2_dashboard')
+urlpatterns = [url(r'^$', views.dashboard, {}, name='geocamPycroraptor2_dashboard'),
+               url(r'^status\.json$', views.dashboardStatus, {},
+                   name='geocamPycroraptor2_dashboardStatus'),
 ]
@@ -5,11 +5,13 @@
 # __END_LICENSE__
 
 import os
+import sys
 import pty
 import logging
 import errno
 import time
 import json
+import hashlib
 import subprocess
 
 import gevent
@@ -55,30 +57,120 @@ class FdTracker(object):
 trackerG = FdTracker()
 
 
-def loadConfig(path):
+def getConfigCacheDir():
+    """
+    Directory for cached output of executable config files. Override
+    with the PYRAPTORD_CACHE_DIR environment variable.
+    """
+    cacheDir = os.environ.get('PYRAPTORD_CACHE_DIR')
+    if cacheDir:
+        return cacheDir
+    xdgCache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(xdgCache, 'pyraptord')
+
+
+def _getConfigCachePath(path, cacheDir):
+    name = hashlib.sha1(os.path.abspath(path)).hexdigest()
+    return os.path.join(cacheDir, name + '.json')
+
+
+def _getConfigEnvDigest():
+    """
+    Hash of the environment a config script runs in, so its cached
+    output is not reused after an environment variable changes (or
+    under a different interpreter).
+    """
+    h = hashlib.sha1()
+    h.update(sys.executable or '')
+    h.update('\0' + sys.version)
+    for key, value in sorted(os.environ.items()):
+        h.update('\0%s=%s' % (key, value))
+    return h.hexdigest()
+
+
+def _readConfigCache(cachePath, digest, mtime, envDigest):
+    try:
+        entry = json.loads(open(cachePath, 'r').read())
+    except (IOError, ValueError):
+        return None
+    if (entry.get('sha1') != digest or entry.get('mtime') != mtime
+            or entry.get('env') != envDigest):
+        return None
+    return entry.get('config')
+
+
+def _writeConfigCache(cachePath, path, digest, mtime, envDigest, configObject):
+    try:
+        cacheDir = os.path.dirname(cachePath)
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir, 0700)
+        tmpPath = '%s.%s.tmp' % (cachePath, os.getpid())
+        out = open(tmpPath, 'w')
+        try:
+            json.dump(dict(path=os.path.abspath(path),
+                           sha1=digest,
+                           mtime=mtime,
+                           env=envDigest,
+                           config=configObject),
+                      out)
+        finally:
+            out.close()
+        os.rename(tmpPath, cachePath)
+    except (IOError, OSError):
+        logging.warning('could not write config cache %s', cachePath)
+
+
+def _runConfigScript(path):
+    logging.info('config file "%s" is executable; running it and using output as config data',
+                 path)
+    p = os.path.abspath(path)
+    proc = subprocess.Popen([p], stdout=subprocess.PIPE)
+    stdoutData, _stderrData = proc.communicate()
+    if proc.returncode != 0:
+        logging.warning('executing config file "%s" failed with return code %s',
+                        path, proc.returncode)
+    return json.loads(stdoutData), proc.returncode
+
+
+def loadConfig(path, useCache=True):
+    """
+    Load the config file at *path*. If the file is not JSON but is
+    executable, run it and use its output as the config. The output is
+    cached in getConfigCacheDir(), keyed by the script's content hash
+    and modification time and by the environment and interpreter, so
+    the script only runs again when one of those changes (or when
+    *useCache* is false).
+    """
     configObject = None
 
     # if config file is valid JSON, interpret it as JSON
     text = open(path, 'r').read()
-    try:
-        configObject = json.loads(text)
-    except ValueError:
-        if os.access(path, os.X_OK):
-            pass
-        else:
-            raise
+    isScript = text.startswith('#!') and os.access(path, os.X_OK)
+    if not isScript:
+        try:
+            configObject = json.loads(text)
+        except ValueError:
+            if os.access(path, os.X_OK):
+                pass
+            else:
+                raise
 
     # fallback plan -- execute config file and use its output
     if configObject is None:
-        logging.info('config file "%s" is executable; running it and using output as config data',
-                     path)
-        p = os.path.abspath(path)
-        proc = subprocess.Popen([p], stdout=subprocess.PIPE)
-        stdoutData, _stderrData = proc.communicate()
-        if proc.returncode != 0:
-            logging.warning('executing config file "%s" failed with return code %s',
-                            path, proc.returncode)
-        configObject = json.loads(stdoutData)
+        cachePath = None
+        if useCache:
+            digest = hashlib.sha1(text).hexdigest()
+            mtime = os.stat(path).st_mtime
+            envDigest = _getConfigEnvDigest()
+            cachePath = _getConfigCachePath(path, getConfigCacheDir())
+            configObject = _readConfigCache(cachePath, digest, mtime, envDigest)
+            if configObject is not None:
+                logging.debug('using cached output of config file "%s" from %s',
+                              path, cachePath)
+        if configObject is None:
+            configObject, returnCode = _runConfigScript(path)
+            if cachePath is not None and returnCode == 0:
+                _writeConfigCache(cachePath, path, digest, mtime, envDigest, configObject)
 
     return convertToDotDictRecurse(configObject)
 
@@ -142,6 +234,40 @@ def getPid(pidPath):
         return None
 
 
+def getReturnCode(sts):
+    """
+    Convert a raw waitpid() status *sts* to a Popen-style return code
+    (negative signal number if the process was killed by a signal).
+    """
+    if os.WIFSIGNALED(sts):
+        return -os.WTERMSIG(sts)
+    elif os.WIFEXITED(sts):
+        return os.WEXITSTATUS(sts)
+    else:
+        raise RuntimeError("don't understand exit status %s" % sts)
+
+
+def watchChild(pid, callback, *args):
+    """
+    Call callback(rstatus, *args) from the gevent hub as soon as child
+    process *pid* exits, where *rstatus* is the raw waitpid() status.
+    This uses the hub's SIGCHLD-driven child watcher, so it costs
+    nothing while the child is running. The callback runs in the hub
+    and must not block; spawn a greenlet for any real work.
+
+    The watcher must be registered before the caller next yields to the
+    hub, otherwise the exit status may be reaped without notification.
+    """
+    watcher = gevent.get_hub().loop.child(pid, False)
+
+    def handleExit():
+        watcher.stop()
+        callback(watcher.rstatus, *args)
+
+    watcher.start(handleExit)
+    return watcher
+
+
 def waitUntilDead(pid, timeout):
     startTime = time.time()
     while 1:
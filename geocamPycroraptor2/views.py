@@ -3,11 +3,15 @@
 # the Administrator of the National Aeronautics and Space Administration.
 # All Rights Reserved.
 # __END_LICENSE__
+import os
 import traceback
 import sys
 import json
+import time
+import threading
 
 from django.shortcuts import render
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.template import RequestContext
 from django.conf import settings
 from django.middleware.csrf import get_token
@@ -16,13 +20,105 @@ import zerorpc
 from geocamPycroraptor2 import status as statuslib
 
 
+# how long a dashboard status request waits for a change
+STATUS_WAIT_SECONDS = 25
+
+# ping pooled clients that have been idle longer than this before reuse
+CLIENT_HEALTH_CHECK_SECONDS = 30
+CLIENT_HEALTH_CHECK_TIMEOUT = 2
+
+_portsCache = {}
+_portsLock = threading.Lock()
+
+# zerorpc clients are not thread-safe, so each thread keeps its own pool
+_clientPool = threading.local()
+
+
+def getPorts(path):
+    """
+    Return the parsed ports file at *path*, re-reading it only when its
+    modification time changes.
+    """
+    mtime = os.stat(path).st_mtime
+    with _portsLock:
+        cached = _portsCache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    ports = json.loads(file(path, 'r').read())
+    with _portsLock:
+        _portsCache[path] = (mtime, ports)
+    return ports
+
+
+def _getPool():
+    pool = getattr(_clientPool, 'clients', None)
+    if pool is None:
+        pool = {}
+        _clientPool.clients = pool
+    return pool
+
+
+def _isHealthy(client):
+    try:
+        client('_zerorpc_ping', timeout=CLIENT_HEALTH_CHECK_TIMEOUT)
+        return True
+    except:  # pylint: disable=W0702
+        return False
+
+
+def discardPyraptordClient(client):
+    """
+    Drop *client* from the pool, for example after an RPC on it failed
+    with a connection error.
+    """
+    pool = _getPool()
+    for endpoint, (pooledClient, _lastUsed) in pool.items():
+        if pooledClient is client:
+            del pool[endpoint]
+    try:
+        client.close()
+    except:  # pylint: disable=W0702
+        pass
+
+
 def getPyraptordClient(clientName='pyraptord'):
-    ports = json.loads(file(settings.ZEROMQ_PORTS, 'r').read())
-    rpcPort = ports[clientName]['rpc']
-    client = zerorpc.Client(rpcPort)
+    """
+    Return a zerorpc client for *clientName* from the ports file. Clients
+    are pooled per thread and endpoint; a client that has been idle for
+    a while is pinged before reuse and replaced if it doesn't answer.
+    """
+    rpcPort = getPorts(settings.ZEROMQ_PORTS)[clientName]['rpc']
+    pool = _getPool()
+    now = time.time()
+    entry = pool.get(rpcPort)
+    if entry is not None:
+        client, lastUsed = entry
+        if now - lastUsed > CLIENT_HEALTH_CHECK_SECONDS and not _isHealthy(client):
+            discardPyraptordClient(client)
+            entry = None
+    if entry is None:
+        client = zerorpc.Client(rpcPort)
+    pool[rpcPort] = (client, now)
     return client
 
 
+def getStatusAndConfig(pyraptord):
+    """
+    Return (status, serviceConfig, statusVersion, statusEpoch) with one
+    round trip, falling back to two RPCs for pyraptord instances that
+    predate getStatusAndConfig(). In that case statusVersion and
+    statusEpoch are None.
+    """
+    try:
+        result = pyraptord.getStatusAndConfig()
+    except zerorpc.RemoteError, err:
+        if err.name != 'NameError':
+            raise
+        return pyraptord.getStatusAll(), pyraptord.getConfig('SERVICES'), None, None
+    return (result['status'], result['services'], result.get('version'),
+            result.get('epoch'))
+
+
 def commandButton(cmd, svcName, disabled=False):
     disabledFlag = ''
     if disabled:
@@ -37,8 +133,11 @@ def renderDashboard(request, pyraptord=None, cmd=None, response=None):
 
     logDir = getattr(settings, 'SERVICES_LOG_DIR_URL', None)
 
-    status = pyraptord.getStatusAll()
-    serviceConfig = pyraptord.getConfig('SERVICES')
+    try:
+        status, serviceConfig, statusVersion, statusEpoch = getStatusAndConfig(pyraptord)
+    except (zerorpc.LostRemote, zerorpc.TimeoutExpired):
+        discardPyraptordClient(pyraptord)
+        raise
 
     configItems = serviceConfig.items()
     configItems.sort()
@@ -55,9 +154,9 @@ def renderDashboard(request, pyraptord=None, cmd=None, response=None):
         procStatus = status.get(name, {'status': 'notStarted'})
         procMode = procStatus.get('status')
         procColor = statuslib.getColor(procMode)
-        tb.append('<tr>')
+        tb.append('<tr data-service="%s">' % name)
         tb.append('<td>%s</td>' % name)
-        tb.append('<td style="background-color: %s;">%s</td>' % (procColor, procMode))
+        tb.append('<td class="serviceStatus" style="background-color: %s;">%s</td>' % (procColor, procMode))
         tb.append('<td>%s</td>' % commandButton('start', name, disabled=not statuslib.isStartable(procMode)))
         tb.append('<td>%s</td>' % commandButton('stop', name, disabled=not statuslib.isActive(procMode)))
         tb.append('<td>%s</td>' % commandButton('restart', name))
@@ -84,10 +183,50 @@ def renderDashboard(request, pyraptord=None, cmd=None, response=None):
 
     return render(request,
                   'geocamPycroraptor2/dashboard.html',
-                  {'html': ''.join(tb)},
+                  {'html': ''.join(tb),
+                   'statusVersion': statusVersion,
+                   'statusEpoch': statusEpoch,
+                   'statusWaitSeconds': STATUS_WAIT_SECONDS},
                   )
 
 
+def dashboardStatus(request):
+    """
+    Long-poll endpoint for the dashboard. Returns JSON with the new
+    status 'version' and the 'changes' since the 'version' query
+    parameter, waiting up to STATUS_WAIT_SECONDS for something to
+    change. A removed service has status null. 'reset' is true if
+    pyraptord restarted since the 'epoch' query parameter was issued.
+    """
+    try:
+        version = int(request.GET.get('version', 0))
+    except ValueError:
+        return HttpResponseBadRequest('version must be an integer')
+    epoch = request.GET.get('epoch') or None
+    pyraptord = getPyraptordClient()
+    try:
+        result = pyraptord.getStatusChanges(version, STATUS_WAIT_SECONDS, epoch,
+                                            timeout=STATUS_WAIT_SECONDS + 10)
+    except (zerorpc.LostRemote, zerorpc.TimeoutExpired):
+        discardPyraptordClient(pyraptord)
+        raise
+    changes = {}
+    for name, procStatus in result['changes'].iteritems():
+        if procStatus is None:
+            changes[name] = None
+            continue
+        procMode = procStatus.get('status')
+        changes[name] = dict(status=procMode,
+                             color=statuslib.getColor(procMode),
+                             startable=statuslib.isStartable(procMode),
+                             active=statuslib.isActive(procMode))
+    return HttpResponse(json.dumps(dict(version=result['version'],
+                                        epoch=result.get('epoch'),
+                                        reset=result.get('reset', False),
+                                        changes=changes)),
+                        content_type='application/json')
+
+
 def runCommandInternal(pyraptord, cmd, svcName):
     response = 'ok'
     try:
@@ -0,0 +1,262 @@
+# __BEGIN_LICENSE__
+# Copyright (C) 2008-2010 United States Government as represented by
+# the Administrator of the National Aeronautics and Space Administration.
+# All Rights Reserved.
+# __END_LICENSE__
+
+"""
+Launcher helper process for pyraptord.
+
+pyraptord runs this file as a separate, freshly started Python process
+with a Unix stream socket on fd 0. It receives spawn requests over the
+socket, with the child's console fds attached as SCM_RIGHTS ancillary
+data, and does the fork/exec on pyraptord's behalf. Because this process
+stays small, the cost of fork() does not grow with the size of the
+pyraptord heap.
+
+Messages in both directions are a 4-byte big-endian length followed by
+a JSON object:
+
+  request  {"op": "spawn", "id": n, "args": [...], "env": {...},
+            "cwd": ..., "fds": [childFd, ...],
+            "stdinPath": ..., "stdoutPath": ...,
+            "rlimits": [[name, soft, hard], ...], "cgroupProcs": ...}
+           followed by one passed fd for each entry in "fds"
+  reply    {"op": "spawned", "id": n, "pid": pid}
+           {"op": "error", "id": n, "errno": e, "message": ...}
+  event    {"op": "exit", "pid": pid, "status": rawWaitStatus}
+
+This module must only import the standard library; it does not run
+inside pyraptord.
+"""
+
+import os
+import sys
+import json
+import errno
+import fcntl
+import select
+import resource
+import signal
+import socket
+import struct
+import traceback
+import _multiprocessing
+
+HEADER = struct.Struct('>I')
+
+try:
+    MAXFD = os.sysconf("SC_OPEN_MAX")
+except:  # pylint: disable=W0702
+    MAXFD = 256
+
+
+def recvExactly(sock, n):
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(n)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return ''.join(chunks)
+
+
+def recvMessage(sock):
+    header = recvExactly(sock, HEADER.size)
+    if header is None:
+        return None
+    (length,) = HEADER.unpack(header)
+    body = recvExactly(sock, length)
+    if body is None:
+        return None
+    return json.loads(body)
+
+
+def encodeMessage(msg):
+    body = json.dumps(msg)
+    return HEADER.pack(len(body)) + body
+
+
+def sendMessage(sock, msg):
+    sock.sendall(encodeMessage(msg))
+
+
+def toStr(val):
+    if isinstance(val, unicode):
+        return val.encode('utf8')
+    return str(val)
+
+
+def execChild(msg, fds, errWrite):
+    """
+    Runs in the forked child. Never returns.
+    """
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+        for childFd, fd in zip(msg['fds'], fds):
+            os.dup2(fd, childFd)
+
+        stdinPath = msg.get('stdinPath')
+        if stdinPath:
+            fd = os.open(toStr(stdinPath), os.O_RDONLY)
+            os.dup2(fd, 0)
+            os.close(fd)
+
+        stdoutPath = msg.get('stdoutPath')
+        if stdoutPath:
+            try:
+                fd = os.open(toStr(stdoutPath), os.O_WRONLY)
+            except:  # pylint: disable=W0702
+                print >> sys.stderr, traceback.format_exc()
+                print >> sys.stderr, 'could not open %s for writing' % stdoutPath
+                os._exit(1)
+            os.dup2(fd, 1)
+            os.close(fd)
+
+        os.closerange(3, errWrite)
+        os.closerange(errWrite + 1, MAXFD)
+
+        if msg.get('cwd'):
+            os.chdir(toStr(msg['cwd']))
+
+        # see limits.enterLimits()
+        if msg.get('cgroupProcs'):
+            with open(toStr(msg['cgroupProcs']), 'w') as f:
+                f.write('0')
+        for name, soft, hard in msg.get('rlimits') or []:
+            resource.setrlimit(getattr(resource, toStr(name)), (soft, hard))
+
+        args = [toStr(arg) for arg in msg['args']]
+        env = dict([(toStr(k), toStr(v)) for k, v in msg['env'].iteritems()])
+        os.execvpe(args[0], args, env)
+    except OSError, oe:
+        os.write(errWrite, '%d:%s' % (oe.errno, oe.strerror))
+    except:  # pylint: disable=W0702
+        os.write(errWrite, '%d:%s' % (errno.EINVAL, traceback.format_exc()))
+    finally:
+        os._exit(127)
+
+
+class ZygoteServer(object):
+    def __init__(self, sock):
+        self._sock = sock
+        # errpipe read fd -> (request id, pid)
+        self._pending = {}
+        # pids whose exec failed; their exit is not reported
+        self._failed = set()
+        self._sigRead, self._sigWrite = os.pipe()
+        for fd in (self._sigRead, self._sigWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        signal.signal(signal.SIGCHLD, self._handleSigchld)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def _handleSigchld(self, sigNum, frame):
+        try:
+            os.write(self._sigWrite, 'x')
+        except OSError:
+            pass  # pipe full, a wakeup is already pending
+
+    def _spawn(self, msg):
+        fds = [_multiprocessing.recvfd(self._sock.fileno())
+               for _ in msg['fds']]
+        errRead, errWrite = os.pipe()
+        fcntl.fcntl(errWrite, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            pid = os.fork()
+        except OSError, oe:
+            os.close(errRead)
+            os.close(errWrite)
+            for fd in fds:
+                os.close(fd)
+            sendMessage(self._sock, dict(op='error', id=msg['id'],
+                                         errno=oe.errno, message=oe.strerror))
+            return
+        if pid == 0:
+            execChild(msg, fds, errWrite)
+        os.close(errWrite)
+        for fd in fds:
+            os.close(fd)
+        self._pending[errRead] = (msg['id'], pid)
+
+    def _finishSpawn(self, errRead):
+        requestId, pid = self._pending.pop(errRead)
+        data = []
+        while 1:
+            chunk = os.read(errRead, 4096)
+            if not chunk:
+                break
+            data.append(chunk)
+        os.close(errRead)
+        data = ''.join(data)
+        if data:
+            errNum, message = data.split(':', 1)
+            self._failed.add(pid)
+            sendMessage(self._sock, dict(op='error', id=requestId,
+                                         errno=int(errNum), message=message))
+        else:
+            sendMessage(self._sock, dict(op='spawned', id=requestId, pid=pid))
+
+    def _reap(self):
+        try:
+            while os.read(self._sigRead, 4096):
+                pass
+        except OSError:
+            pass
+        while 1:
+            try:
+                pid, sts = os.waitpid(-1, os.WNOHANG)
+            except OSError, oe:
+                if oe.errno == errno.EINTR:
+                    continue
+                break  # ECHILD
+            if pid == 0:
+                break
+            for errRead, (_requestId, pendingPid) in self._pending.items():
+                if pendingPid == pid:
+                    self._finishSpawn(errRead)
+            if pid in self._failed:
+                self._failed.discard(pid)
+            else:
+                sendMessage(self._sock, dict(op='exit', pid=pid, status=sts))
+
+    def run(self):
+        while 1:
+            try:
+                readable, _, _ = select.select([self._sock, self._sigRead]
+                                               + self._pending.keys(),
+                                               [], [])
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            # spawn replies must go out before exit events for the same pid
+            for errRead in readable:
+                if errRead in self._pending:
+                    self._finishSpawn(errRead)
+            if self._sigRead in readable:
+                self._reap()
+            if self._sock in readable:
+                msg = recvMessage(self._sock)
+                if msg is None:
+                    # pyraptord went away
+                    return
+                if msg['op'] == 'spawn':
+                    self._spawn(msg)
+
+
+def main():
+    sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    # children that don't get a stdin fd should not inherit the socket
+    devNull = os.open('/dev/null', os.O_RDONLY)
+    os.dup2(devNull, 0)
+    os.close(devNull)
+    ZygoteServer(sock).run()
+
+
+if __name__ == '__main__':
+    main()